@@ -0,0 +1,43 @@
+#!/usr/bin/python
+# ------------------------------------------------------------
+# convertDictionaries.py
+# 
+# Python script to convert a pickled dictionary file into a
+# memory-mappable dataset directory.
+#
+# ------------------------------------------------------------
+
+import os, os.path
+import sys
+import argparse
+
+from messageStore import MessageStore, messageStoreFromDicts
+from messageStore import messageStoreSave, loadDictionaries
+
+
+# ------------------------------------------------------------
+# MAIN
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+    description='Convert pickled dictionaries to a dataset directory.')
+
+  parser.add_argument('dictFile',
+                      help='Pickled dictionary file')
+
+  parser.add_argument('outDir',
+                      help='Dataset output directory')
+
+  args = parser.parse_args()
+  sys.stdout.write("dictFile: {}\n".format(str(args.dictFile)))
+  sys.stdout.write("  outDir: {}\n".format(str(args.outDir)))
+
+  dictMessages, dictTagCounts, dictTagIndex = loadDictionaries(args.dictFile)
+
+  # Older files hold dictionaries of Counters rather than a store
+  if (not isinstance(dictMessages, MessageStore)):
+    dictMessages = messageStoreFromDicts(dictMessages, 
+                                         sorted(dictTagIndex.keys()))
+
+  messageStoreSave(dictMessages, args.outDir)
+  sys.stdout.write("Converted {} messages\n".format(len(dictMessages)))
@@ -21,7 +21,30 @@ import cPickle as pickle
 from collections import Counter
 from HTMLParser import HTMLParser
 
-import nltk
+from messageStore import MessageStoreBuilder
+
+
+# ------------------------------------------------------------
+# MESSAGES
+
+def iterMessages(msgFile, tagList):
+  # Generator over the messages in a CSV file produced by 
+  # createFilteredDataset. Yields (sid, message) pairs where message 
+  # has the same layout as the dictMessages entries. Messages without
+  # any tag in tagList are skipped.
+  tagSet = set(tagList)
+  with open(msgFile) as fd:
+    tmp_reader = csv.reader(fd, delimiter=',', quotechar='"')
+    headings = tmp_reader.next()
+
+    for sample in tmp_reader:
+      tags = [t for t in sample[3].split() if t in tagSet]
+      if (len(tags)==0):
+        continue 
+
+      yield sample[0], {'tags':tags,
+                        'title':Counter(sample[1].split()),
+                        'body':Counter(sample[2].split())}
 
 
 # ------------------------------------------------------------
@@ -39,6 +62,11 @@ if __name__ == "__main__":
   parser.add_argument('dictFile',
                       help='Dictionary output file')
 
+  parser.add_argument('-legacy',
+                      action="store_true",
+                      dest="legacy",
+                      help='Store messages as dictionaries of Counters')
+
   args = parser.parse_args()
   sys.stdout.write(" msgFile: {}\n".format(str(args.msgFile)))
   sys.stdout.write(" tagFile: {}\n".format(str(args.tagFile)))
@@ -50,37 +78,30 @@ if __name__ == "__main__":
   fd.close()
   tagList = tagsString.split()
 
-  # Open the training file and
-  fd = open(args.msgFile)
-  tmp_reader = csv.reader(fd, delimiter=',', quotechar='"')
-  headings = tmp_reader.next()
-
-  # Create dictionaries
+  # Create dictionaries. Unless asked for the legacy format, messages
+  # are packed into a MessageStore with integer word and tag IDs.
   dictMessages   = {}
+  storeBuilder   = MessageStoreBuilder(tagList)
   dictTagCounts  = Counter()    
   dictTagIndex   = {}
 
   for t in tagList:
     dictTagIndex[t] = []
 
-  for sample in tmp_reader:
-    sid   = sample[0]
-    title = sample[1].split()
-    body  = sample[2].split()
-    tags  = [t for t in sample[3].split() if t in tagList]
+  for sid, message in iterMessages(args.msgFile, tagList):
+    tags = message['tags']
+    if (args.legacy):
+      dictMessages[sid] = message
+    else:
+      storeBuilder.add(sid, tags, message)
 
-    if (len(tags)==0):
-      continue 
-
-    dictMessages[sid] = {'tags':tags, 
-                         'title':Counter(title),
-                         'body':Counter(body)}
     dictTagCounts.update(tags)
 
     for t in tags:
       dictTagIndex[t].append(sid)
 
-  fd.close()
+  if (not args.legacy):
+    dictMessages = storeBuilder.build()
 
   # Write dictionaries out in pickle file
   outstream = open(args.dictFile, 'wb')
@@ -21,14 +21,21 @@ import cPickle as pickle
 from collections import Counter
 from HTMLParser import HTMLParser
 
+import multiprocessing
 import nltk
 import pdb
 
+from collections import deque
+
 # ------------------------------------------------------------
 # TEXT CLEANUP
 
 STOP_FILE = "data/english.stop"
 stopwords = set()
+NUMRE     = re.compile(r"^[0-9]+$")
+
+# Rows handed to each worker process at a time with -j
+CHUNK_SIZE = 500
 
 def load_stopwords():
   global stopwords
@@ -43,12 +50,77 @@ def clean_text(s):
   s = nltk.clean_html(s)
   s = s.lower()
   s = s.translate(None, string.punctuation)
-  NUMRE = re.compile(r"^[0-9]+$")
   s = [x for x in s.split() if not NUMRE.match(x)]
   s = [x for x in s if not x in stopwords]
   return s
 
 
+def clean_row(row):
+  sid, title, body, tags = row
+  return [sid, ' '.join(clean_text(title)), ' '.join(clean_text(body)), 
+          ' '.join(tags)]
+
+
+def clean_rows(rows):
+  return [clean_row(row) for row in rows]
+
+
+def iterSelectedRows(reader, tagsList, skip, limit, counts):
+  # Applies the tag filter and the skip and limit options to the
+  # input rows. Yields (sid, title, body, tags) for every row to write
+  # and keeps the raw and written row counts in counts.
+  skipcnt = 0
+  for sample in reader:
+    counts['raw'] += 1
+    tags  = [t for t in sample[3].split() if t in tagsList]
+
+    if (len(tags)==0):
+      continue 
+
+    skipcnt += 1
+    if (skipcnt < skip):
+      continue
+
+    yield sample[0], sample[1], sample[2], tags
+
+    counts['cnt'] += 1
+    if (limit and counts['cnt'] > limit):
+      break 
+
+
+def iterChunks(rows, size):
+  chunk = []
+  for row in rows:
+    chunk.append(row)
+    if (len(chunk) == size):
+      yield chunk
+      chunk = []
+  if (len(chunk) > 0):
+    yield chunk
+
+
+def iterCleanMessages(trainFile, tagsList):
+  # Generator over a raw training CSV file that applies the same tag
+  # filtering and text cleanup as this script. Yields (sid, message)
+  # pairs laid out like the dictMessages entries of createDictionaries.
+  if (len(stopwords) == 0):
+    load_stopwords()
+
+  tagSet = set(tagsList)
+  with open(trainFile) as fd:
+    tmp_reader = csv.reader(fd, delimiter=',', quotechar='"')
+    headings = tmp_reader.next()
+
+    for sample in tmp_reader:
+      tags = [t for t in sample[3].split() if t in tagSet]
+      if (len(tags)==0):
+        continue 
+
+      yield sample[0], {'tags':tags,
+                        'title':Counter(clean_text(sample[1])),
+                        'body':Counter(clean_text(sample[2]))}
+
+
 # ------------------------------------------------------------
 # MAIN
 
@@ -79,12 +151,20 @@ if __name__ == "__main__":
                      default=0,
                      help='skip')
 
+  parser.add_argument('-j',
+                     action="store",
+                     type=int,
+                     dest="jobs",
+                     default=1,
+                     help='Number of worker processes')
+
   args = parser.parse_args()
   sys.stdout.write("  Train: {}\n".format(str(args.trainFile)))
   sys.stdout.write(" Output: {}\n".format(str(args.trainFileNew)))
   sys.stdout.write("tagFile: {}\n".format(str(args.tagFile)))
   sys.stdout.write("  Limit: {}\n".format(str(args.limit)))
   sys.stdout.write("   Skip: {}\n".format(str(args.skip)))
+  sys.stdout.write("   Jobs: {}\n".format(str(args.jobs)))
 
   # Open and process the tag filter list file
   fd = open(args.tagFile)
@@ -107,35 +187,31 @@ if __name__ == "__main__":
   tmp_writer.writerow(headings)
 
 
-  # Loop over training samples and count each pair
-  # of tags that appear together. 
-  cnt     = 0
-  skipcnt = 0
-  rawcnt  = 0
-  for sample in tmp_reader:
-    # NB - sort first to ensure pairs map to same tuple!
-    rawcnt += 1
-    sid   = sample[0]
-    title = sample[1]
-    body  = sample[2]
-    tags  = [t for t in sample[3].split() if t in tagsList]
-
-    if (len(tags)==0):
-      continue 
-
-    skipcnt += 1
-    if (skipcnt < args.skip):
-      continue
-
-    # Process stuff here
-    newTitle = ' '.join(clean_text(title))
-    newBody  = ' '.join(clean_text(body))
-    newTags  = ' '.join(tags)
-    tmp_writer.writerow([sid, newTitle, newBody, newTags])
-
-    cnt += 1
-    if (args.limit and cnt > args.limit):
-      break 
+  # Loop over training samples, keeping those with selected tags,
+  # and clean their text. With -j the cleaning is spread over a pool
+  # of processes in ordered chunks. The number of chunks in flight is
+  # bounded so the input is never read far ahead of the output.
+  counts = {'raw': 0, 'cnt': 0}
+  rows   = iterSelectedRows(tmp_reader, tagsList, args.skip, args.limit, counts)
+
+  if (args.jobs > 1):
+    pool    = multiprocessing.Pool(args.jobs, load_stopwords)
+    pending = deque()
+    for chunk in iterChunks(rows, CHUNK_SIZE):
+      pending.append(pool.apply_async(clean_rows, (chunk,)))
+      if (len(pending) >= 2*args.jobs):
+        tmp_writer.writerows(pending.popleft().get())
+
+    while (len(pending) > 0):
+      tmp_writer.writerows(pending.popleft().get())
+    pool.close()
+    pool.join()
+  else:
+    for row in rows:
+      tmp_writer.writerow(clean_row(row))
+
+  cnt    = counts['cnt']
+  rawcnt = counts['raw']
 
   fd.close()
   fdw.close()
@@ -13,10 +13,60 @@ import sys
 import argparse
 import csv
 import itertools
+import heapq
 from collections import Counter
 import cPickle as pickle
 
 
+# ------------------------------------------------------------
+# APPROXIMATE COUNTING
+#
+# Space-Saving heavy hitter summary (Metwally et al., 2005). At 
+# most `capacity` pairs are tracked. When a new pair arrives and
+# the summary is full, the pair with the smallest count is evicted
+# and the new pair inherits that count as its error. Every tracked
+# count over-estimates the true count by at most its error, and any
+# pair whose true count exceeds total/capacity is always tracked.
+
+def spaceSavingNew(capacity):
+  summary = {}
+  summary['capacity'] = capacity
+  summary['total']    = 0
+  summary['counts']   = {}
+  summary['errors']   = {}
+  summary['heap']     = []
+  return summary
+
+
+def spaceSavingAdd(summary, key):
+  counts = summary['counts']
+  summary['total'] += 1
+  if (key in counts):
+    # The heap entry for this key is now stale and is fixed up
+    # lazily when it reaches the top.
+    counts[key] += 1
+    return
+
+  heap = summary['heap']
+  if (len(counts) < summary['capacity']):
+    counts[key] = 1
+    summary['errors'][key] = 0
+    heapq.heappush(heap, (1, key))
+    return
+
+  # Find the true minimum, refreshing stale entries on the way
+  minCount, minKey = heapq.heappop(heap)
+  while (counts[minKey] != minCount):
+    heapq.heappush(heap, (counts[minKey], minKey))
+    minCount, minKey = heapq.heappop(heap)
+
+  del counts[minKey]
+  del summary['errors'][minKey]
+  counts[key] = minCount + 1
+  summary['errors'][key] = minCount
+  heapq.heappush(heap, (minCount + 1, key))
+
+
 # ------------------------------------------------------------
 # MAIN
 
@@ -36,10 +86,23 @@ if __name__ == "__main__":
                      default=None,
                      help='Limit')
 
+  parser.add_argument('-m',
+                     action="store",
+                     type=int,
+                     dest="maxPairs",
+                     default=None,
+                     help='Approximate counts tracking at most this many tag pairs')
+
   args = parser.parse_args()
+
+  if ((args.maxPairs is not None) and (args.maxPairs < 1)):
+    print("Error, -m must be at least 1")
+    sys.exit()
+
   sys.stdout.write("   Train: {}\n".format(str(args.trainFile)))
   sys.stdout.write("EdgeList: {}\n".format(str(args.edgeFile)))
-  sys.stdout.write("   Limit: {}".format(str(args.limit)))
+  sys.stdout.write("   Limit: {}\n".format(str(args.limit)))
+  sys.stdout.write("MaxPairs: {}".format(str(args.maxPairs)))
 
   # Open the training file and get tags. 
   fd = open(args.trainFile)
@@ -50,12 +113,20 @@ if __name__ == "__main__":
   headings = tmp_reader.next()
   tagEdges = Counter()
   tagLengths = Counter()
+  if (args.maxPairs is not None):
+    summary  = spaceSavingNew(args.maxPairs)
+    tagEdges = summary['counts']
+
   cnt = 1
   for sample in tmp_reader:
     # NB - sort first to ensure pairs map to same tuple!
     tags = sorted(sample[3].split())
     tagLengths[len(tags)] += 1     
-    tagEdges.update([tp for tp in itertools.combinations(tags,2)])
+    if (args.maxPairs is None):
+      tagEdges.update([tp for tp in itertools.combinations(tags,2)])
+    else:
+      for tp in itertools.combinations(tags,2):
+        spaceSavingAdd(summary, tp)
     cnt += 1
     if (args.limit and cnt > args.limit):
       break 
@@ -63,12 +134,36 @@ if __name__ == "__main__":
   sys.stdout.write("\nProcessed {} entries\n".format(str(cnt)))    
   sys.stdout.write("Found: {} tag pairs\n".format(str(len(tagEdges))))
 
+  # With approximate counts only the heavy pairs, those whose
+  # guaranteed count is above total/maxPairs, go in the edge list,
+  # with that guaranteed count. Every tracked pair is written with
+  # the bounds on its true count to a separate file.
+  edgeCounts = tagEdges
+  if (args.maxPairs is not None):
+    errors     = summary['errors']
+    threshold  = summary['total'] / args.maxPairs
+    edgeCounts = {edge: count - errors[edge] for edge, count in tagEdges.items()
+                  if (count - errors[edge] > threshold)}
+
+    with open(args.edgeFile+'_bounds.csv', 'wb') as fdBounds:
+      writer = csv.writer(fdBounds, delimiter=',',
+                          quotechar='"', quoting=csv.QUOTE_MINIMAL)
+      for edge, count in tagEdges.items():
+        writer.writerow([edge[0], edge[1], count - errors[edge], count])
+
+    sys.stdout.write("Counted {} pair occurrences\n".format(str(summary['total'])))
+    sys.stdout.write("Max count error: {}\n".format(str(max(errors.values() + [0]))))
+    sys.stdout.write("Pairs with guaranteed count above {}: {}\n".format(
+      str(threshold), str(len(edgeCounts))))
+    if (len(edgeCounts) == 0):
+      sys.stdout.write("Warning, no pair passes the threshold, increase -m\n")
+
   # Write edgelist as csv file
   sys.stdout.write("Writing edgelist csv....\n")
   with open(args.edgeFile+'.csv', 'wb') as fdEdge:
      writer = csv.writer(fdEdge, delimiter=',',
                          quotechar='"', quoting=csv.QUOTE_MINIMAL)
-     for edge, count  in tagEdges.items():
+     for edge, count  in edgeCounts.items():
        writer.writerow([edge[0], edge[1], count])
 
   #sys.stdout.write("Writing tagEdges binary dump....\n")
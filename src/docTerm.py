@@ -0,0 +1,130 @@
+# ------------------------------------------------------------
+# docTerm.py
+# 
+# Helpers to pack per-message word counts into sparse
+# document-term matrices for batch training and prediction.
+#
+# ------------------------------------------------------------
+
+import numpy        as np
+import scipy.sparse as sp
+
+from messageStore import MessageStore
+
+
+def docTermMatrix(dictMessages, f, docIDs, wordIndex, oov):
+  # Build a len(docIDs) x (oov+1) CSR matrix of word counts for
+  # field f. Words that are not in wordIndex are summed into the
+  # last column so that callers can apply smoothing to them.
+  if (isinstance(dictMessages, MessageStore)):
+    return storeTermMatrix(dictMessages, f, docIDs, wordIndex, oov)
+
+  indptr  = [0]
+  indices = []
+  data    = []
+  for sid in docIDs:
+    text = dictMessages[sid][f]
+    indices.extend([wordIndex.get(w, oov) for w in text.iterkeys()])
+    data.extend(text.itervalues())
+    indptr.append(len(indices))
+
+  X = sp.csr_matrix((np.array(data, dtype=float),
+                     np.array(indices, dtype=np.int32),
+                     np.array(indptr, dtype=np.int64)),
+                    shape=(len(docIDs), oov + 1))
+  X.sum_duplicates()
+  return X
+
+
+def docTermMatrixVocab(dictMessages, f, docIDs):
+  # Build the doc-term matrix for field f together with the 
+  # vocabulary of the given documents. Returns (X, words) where
+  # column i of X counts words[i].
+  if (isinstance(dictMessages, MessageStore)):
+    store = dictMessages
+    indptr, ids, counts = store.fields[f]
+    nz, lengths = indptrNonzeros(indptr, store.rows(docIDs))
+    storeIDs, columns = np.unique(ids[nz], return_inverse=True)
+
+    X = sp.csr_matrix((counts[nz].astype(float), columns,
+                       np.concatenate([[0], np.cumsum(lengths)])),
+                      shape=(len(docIDs), len(storeIDs)))
+    return X, [store.words[i] for i in storeIDs.tolist()]
+
+  wordIndex = {}
+  words     = []
+  indptr    = [0]
+  indices   = []
+  data      = []
+  for sid in docIDs:
+    for w,c in dictMessages[sid][f].iteritems():
+      i = wordIndex.get(w)
+      if (i is None):
+        i = wordIndex[w] = len(words)
+        words.append(w)
+      indices.append(i)
+      data.append(c)
+    indptr.append(len(indices))
+
+  X = sp.csr_matrix((np.array(data, dtype=float),
+                     np.array(indices, dtype=np.int32),
+                     np.array(indptr, dtype=np.int64)),
+                    shape=(len(docIDs), len(words)))
+  return X, words
+
+
+def docTagMatrix(dictMessages, docIDs, tagList):
+  # Build a len(docIDs) x len(tagList) CSR matrix holding the number
+  # of times each document lists each tag in tagList.
+  tagIndex = {t:i for i,t in enumerate(tagList)}
+  if (isinstance(dictMessages, MessageStore)):
+    store   = dictMessages
+    columns = np.array([tagIndex.get(t, -1) for t in store.tags],
+                       dtype=np.int64)
+    nz, lengths = indptrNonzeros(store.tagIndptr, store.rows(docIDs))
+    rows = np.repeat(np.arange(len(docIDs)), lengths)
+    cols = columns[store.tagIds[nz]]
+  else:
+    rows = []
+    cols = []
+    for i,sid in enumerate(docIDs):
+      for t in dictMessages[sid]['tags']:
+        rows.append(i)
+        cols.append(tagIndex.get(t, -1))
+    rows = np.array(rows, dtype=np.int64)
+    cols = np.array(cols, dtype=np.int64)
+
+  keep = cols >= 0
+  Y = sp.coo_matrix((np.ones(keep.sum()), (rows[keep], cols[keep])),
+                    shape=(len(docIDs), len(tagList)))
+  return Y.tocsr()
+
+
+def storeTermMatrix(store, f, docIDs, wordIndex, oov):
+  # Same as docTermMatrix but slices the store's CSR block directly
+  # and remaps its word IDs to the column IDs in wordIndex.
+  indptr, ids, counts = store.fields[f]
+  nz, lengths = indptrNonzeros(indptr, store.rows(docIDs))
+  columns     = np.array([wordIndex.get(w, oov) for w in store.words],
+                         dtype=np.int32)
+
+  X = sp.csr_matrix((counts[nz].astype(float), columns[ids[nz]],
+                     np.concatenate([[0], np.cumsum(lengths)])),
+                    shape=(len(docIDs), oov + 1))
+  X.sum_duplicates()
+  return X
+
+
+def indptrNonzeros(indptr, rows):
+  # Positions of the non-zeros of the given CSR rows, concatenated
+  # in row order, along with each row's length.
+  rows    = np.asarray(rows, dtype=np.int64)
+  starts  = indptr[rows]
+  lengths = indptr[rows + 1] - starts
+  offsets = np.cumsum(lengths) - lengths
+  nz      = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+  return nz, lengths
+
+
+def rowNonzeros(X, rows):
+  return indptrNonzeros(X.indptr, rows)
@@ -0,0 +1,167 @@
+# ------------------------------------------------------------
+# evaluate.py
+#
+# Evaluation of trained models on a set of test documents,
+# shared by runkfold.py and runtest.py. The test documents can
+# be split into shards that are predicted by a pool of worker
+# processes.
+#
+# ------------------------------------------------------------
+
+import itertools
+import multiprocessing
+
+
+# Data shared with the test worker processes. It is set before the
+# pool is created so forked workers inherit the models and the data
+# set copy-on-write instead of receiving pickled copies.
+testState = {}
+
+# Shards per worker, so slow documents are spread over the pool
+SHARDS_PER_JOB = 4
+
+
+def docScores(tagsActual, predictions):
+  tp = len(tagsActual & predictions)
+  fp = len(predictions - tagsActual)
+  fn = len(tagsActual - predictions)
+
+  if ((tp + fp) > 0):
+    precision = float(tp) / (tp + fp)
+  else:
+    precision = 0
+
+  if ((tp+fn) > 0):
+    recall = float(tp) / (tp + fn)
+  else:
+    recall = 0
+
+  if ((precision + recall) > 0):
+    f1 = 2 * (precision * recall) / (precision + recall)
+  else:
+    f1 = 0
+
+  return (tp, fp, fn, precision, recall, f1)
+
+
+def testShard(docIDs):
+  # Per document scores for a list of test documents, in order
+  fnPredictBatch = testState['fnPredictBatch']
+  models         = testState['models']
+  dictMessages   = testState['dictMessages']
+  tagList        = testState['tagList']
+
+  # Predict each feature for the whole shard in one batch
+  docPredictions = [set() for sid in docIDs]
+  for f in testState['features']:
+    for predictions, tags in zip(docPredictions,
+                                 fnPredictBatch(models, f, dictMessages,
+                                                docIDs, tagList)):
+      predictions.update(tags)
+
+  scores = []
+  for sid, predictions in zip(docIDs, docPredictions):
+    tagsActual  = set([t for t in dictMessages[sid]['tags'] if t in tagList])
+
+    #print(",".join(tagsActual) + " : " + ",".join(predictions))
+    scores.append(docScores(tagsActual, predictions))
+
+  return scores
+
+
+def sweepShard(docIDs):
+  # Per document scores of every grid point for a list of test
+  # documents, in order
+  fnSweepBatch = testState['fnSweepBatch']
+  models       = testState['models']
+  dictMessages = testState['dictMessages']
+  tagList      = testState['tagList']
+  grid         = testState['grid']
+
+  docPredictions = {p: [set() for sid in docIDs] for p in grid}
+  for f in testState['features']:
+    sweep = fnSweepBatch(models, f, dictMessages, docIDs, tagList, grid)
+    for p in grid:
+      for predictions, tags in zip(docPredictions[p], sweep[p]):
+        predictions.update(tags)
+
+  scores = {p: [] for p in grid}
+  for i,sid in enumerate(docIDs):
+    tagsActual = set([t for t in dictMessages[sid]['tags'] if t in tagList])
+    for p in grid:
+      scores[p].append(docScores(tagsActual, docPredictions[p][i]))
+
+  return scores
+
+
+def mapShards(fnShard, testDocIDs, jobs):
+  # With more than one job the documents are split into contiguous
+  # shards. The results come back in document order, so they can be
+  # combined exactly like those of the serial path.
+  if ((jobs > 1) and (len(testDocIDs) > 1)):
+    numShards = min(jobs * SHARDS_PER_JOB, len(testDocIDs))
+    bounds    = [(i * len(testDocIDs)) / numShards for i in range(numShards + 1)]
+    shards    = [testDocIDs[b:e] for b,e in zip(bounds[:-1], bounds[1:])]
+
+    pool    = multiprocessing.Pool(jobs)
+    results = pool.map(fnShard, shards)
+    pool.close()
+    pool.join()
+  else:
+    results = [fnShard(testDocIDs)]
+  return results
+
+
+def sumScores(scores, numTestDocs):
+  results = {'tp': 0, 'fp': 0, 'fn': 0,
+             'mean-prec': 0, 'mean-rec': 0,
+             'mean-f1':0}
+
+  for tp, fp, fn, precision, recall, f1 in scores:
+    results['tp'] += tp
+    results['fp'] += fp
+    results['fn'] += fn
+    results['mean-prec'] += precision
+    results['mean-rec']  += recall
+    results['mean-f1']   += f1
+
+  results['mean-prec'] /= numTestDocs
+  results['mean-rec']  /= numTestDocs
+  results['mean-f1']   /= numTestDocs
+  return results
+
+
+def test(fnPredictBatch, models, features, dictMessages, testDocIDs, tagList,
+         jobs=1):
+  testState.update({'fnPredictBatch': fnPredictBatch, 'models': models,
+                    'features': features, 'dictMessages': dictMessages,
+                    'tagList': tagList})
+
+  scores  = itertools.chain.from_iterable(mapShards(testShard, testDocIDs, jobs))
+  results = sumScores(scores, len(testDocIDs))
+
+  testState.clear()
+  return results
+
+
+def testSweep(fnSweepBatch, models, features, dictMessages, testDocIDs, tagList,
+              grid, jobs=1):
+  # Same as test for every grid point of a parameter sweep. Returns
+  # a dict from each grid point to its results.
+  testState.update({'fnSweepBatch': fnSweepBatch, 'models': models,
+                    'features': features, 'dictMessages': dictMessages,
+                    'tagList': tagList, 'grid': grid})
+
+  shardScores = mapShards(sweepShard, testDocIDs, jobs)
+  results = {}
+  for p in grid:
+    scores     = itertools.chain.from_iterable([s[p] for s in shardScores])
+    results[p] = sumScores(scores, len(testDocIDs))
+
+  testState.clear()
+  return results
+
+
+def resultString(tp, fp, fn, prec, rec, f1):
+  return " {tp} | {fp} | {fn} | {prec:.3f} | {rec:.3f} | {f1:.3f} |".format(
+    tp=tp, fp=fp, fn=fn, prec=prec, rec=rec, f1=f1)
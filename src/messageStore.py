@@ -0,0 +1,336 @@
+# ------------------------------------------------------------
+# messageStore.py
+#
+# Compact storage for pre-processed messages. Words and tags
+# are mapped to integer IDs and every field is held as a single
+# CSR block of int32 word IDs and counts.
+#
+# A MessageStore can be used wherever the dictMessages dictionary
+# is expected: store[sid]['tags'] is the list of tag names and
+# store[sid][field] is a read-only, Counter-like view of the
+# field's word counts.
+#
+# A store can also be saved as a directory of .npy arrays plus
+# plain text vocabulary files. Loading memory-maps the arrays so
+# start-up is fast and concurrent runs share the same pages.
+#
+# ------------------------------------------------------------
+
+import os, os.path
+import itertools
+
+import numpy as np
+
+from collections import Counter
+from cPickle     import Unpickler
+
+FIELDS = ['title', 'body']
+
+
+class TermCounts(object):
+  # Counter-like view of one message field. Word IDs are sorted so
+  # single word lookups can use a binary search.
+  __slots__ = ('store', 'ids', 'counts')
+
+  def __init__(self, store, ids, counts):
+    self.store  = store
+    self.ids    = ids
+    self.counts = counts
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __iter__(self):
+    return self.iterkeys()
+
+  def __contains__(self, w):
+    return self._find(w) is not None
+
+  def __getitem__(self, w):
+    i = self._find(w)
+    if (i is None):
+      return 0
+    return int(self.counts[i])
+
+  def _find(self, w):
+    wid = self.store.wordIndex.get(w)
+    if (wid is None):
+      return None
+    i = np.searchsorted(self.ids, wid)
+    if ((i < len(self.ids)) and (self.ids[i] == wid)):
+      return i
+    return None
+
+  def get(self, w, default=None):
+    i = self._find(w)
+    if (i is None):
+      return default
+    return int(self.counts[i])
+
+  def iterkeys(self):
+    words = self.store.words
+    return (words[i] for i in self.ids.tolist())
+
+  def itervalues(self):
+    return iter(self.counts.tolist())
+
+  def iteritems(self):
+    return itertools.izip(self.iterkeys(), self.itervalues())
+
+  def keys(self):
+    return list(self.iterkeys())
+
+  def values(self):
+    return self.counts.tolist()
+
+  def items(self):
+    return list(self.iteritems())
+
+
+class Message(object):
+  # Record for a single message in a MessageStore.
+  __slots__ = ('store', 'row')
+
+  def __init__(self, store, row):
+    self.store = store
+    self.row   = row
+
+  def __getitem__(self, key):
+    if (key == 'tags'):
+      return self.store.messageTags(self.row)
+    return self.store.messageField(key, self.row)
+
+  def keys(self):
+    return ['tags'] + self.store.fields.keys()
+
+
+class MessageStore(object):
+
+  def __init__(self, docIDs, words, tags, tagIndptr, tagIds, fields):
+    self.docIDs    = docIDs
+    self.words     = words
+    self.tags      = tags
+    self.tagIndptr = tagIndptr
+    self.tagIds    = tagIds
+    self.fields    = fields
+    self._buildIndexes()
+
+  def _buildIndexes(self):
+    self.docIndex  = {sid:i for i,sid in enumerate(self.docIDs)}
+    self.wordIndex = {w:i for i,w in enumerate(self.words)}
+    self.tagIndex  = {t:i for i,t in enumerate(self.tags)}
+
+  def __getstate__(self):
+    # The lookup dictionaries are rebuilt on load
+    return (self.docIDs, self.words, self.tags,
+            self.tagIndptr, self.tagIds, self.fields)
+
+  def __setstate__(self, state):
+    (self.docIDs, self.words, self.tags,
+     self.tagIndptr, self.tagIds, self.fields) = state
+    self._buildIndexes()
+
+  # Dictionary protocol keyed by message ID
+  def __len__(self):
+    return len(self.docIDs)
+
+  def __iter__(self):
+    return iter(self.docIDs)
+
+  def __contains__(self, sid):
+    return sid in self.docIndex
+
+  def __getitem__(self, sid):
+    return Message(self, self.docIndex[sid])
+
+  def keys(self):
+    return list(self.docIDs)
+
+  def iterkeys(self):
+    return iter(self.docIDs)
+
+  def itervalues(self):
+    return (Message(self, i) for i in xrange(len(self.docIDs)))
+
+  def iteritems(self):
+    return itertools.izip(self.iterkeys(), self.itervalues())
+
+  # Row level access
+  def messageTags(self, row):
+    tags = self.tags
+    return [tags[i] for i in
+            self.tagIds[self.tagIndptr[row]:self.tagIndptr[row+1]].tolist()]
+
+  def messageField(self, f, row):
+    indptr, ids, counts = self.fields[f]
+    start = indptr[row]
+    end   = indptr[row+1]
+    return TermCounts(self, ids[start:end], counts[start:end])
+
+  def rows(self, docIDs):
+    docIndex = self.docIndex
+    return np.array([docIndex[sid] for sid in docIDs], dtype=np.int64)
+
+
+class MessageStoreBuilder(object):
+  # Accumulates messages one at a time and packs them into a
+  # MessageStore. Tags in tagList get the first tag IDs, in order.
+
+  def __init__(self, tagList=None, fields=FIELDS):
+    self.docIDs    = []
+    self.words     = []
+    self.wordIndex = {}
+    self.tags      = []
+    self.tagIndex  = {}
+    self.tagIndptr = [0]
+    self.tagIds    = []
+    self.fields    = {f:([0], [], []) for f in fields}
+    for t in (tagList or []):
+      self._tagID(t)
+
+  def _tagID(self, t):
+    tid = self.tagIndex.get(t)
+    if (tid is None):
+      tid = self.tagIndex[t] = len(self.tags)
+      self.tags.append(t)
+    return tid
+
+  def _wordID(self, w):
+    wid = self.wordIndex.get(w)
+    if (wid is None):
+      wid = self.wordIndex[w] = len(self.words)
+      self.words.append(w)
+    return wid
+
+  def add(self, sid, tags, fieldCounts):
+    self.docIDs.append(sid)
+    self.tagIds.extend([self._tagID(t) for t in tags])
+    self.tagIndptr.append(len(self.tagIds))
+    for f, (indptr, ids, counts) in self.fields.iteritems():
+      wordCounts = sorted([(self._wordID(w), c) for w,c in
+                           fieldCounts[f].iteritems()])
+      ids.extend([wid for wid,c in wordCounts])
+      counts.extend([c for wid,c in wordCounts])
+      indptr.append(len(ids))
+
+  def build(self):
+    fields = {}
+    for f, (indptr, ids, counts) in self.fields.iteritems():
+      fields[f] = (np.array(indptr, dtype=np.int64),
+                   np.array(ids,    dtype=np.int32),
+                   np.array(counts, dtype=np.int32))
+
+    return MessageStore(self.docIDs, self.words, self.tags,
+                        np.array(self.tagIndptr, dtype=np.int64),
+                        np.array(self.tagIds,    dtype=np.int32),
+                        fields)
+
+
+def messageStoreFromDicts(dictMessages, tagList=None):
+  # Convert a dictMessages dictionary into a MessageStore
+  builder = MessageStoreBuilder(tagList)
+  for sid, message in dictMessages.iteritems():
+    builder.add(sid, message['tags'], message)
+  return builder.build()
+
+
+def messageStoreFilter(store, dictField):
+  # Return a new MessageStore keeping only the words in
+  # dictField[f] for each field f.
+  fields = {}
+  for f, (indptr, ids, counts) in store.fields.iteritems():
+    keep = np.zeros(len(store.words), dtype=bool)
+    keep[[store.wordIndex[w] for w in dictField[f] 
+          if w in store.wordIndex]] = True
+
+    # Each row's new end is the number of kept words before its old end
+    mask      = keep[ids]
+    kept      = np.concatenate([[0], np.cumsum(mask)]).astype(np.int64)
+    fields[f] = (kept[indptr], ids[mask], counts[mask])
+
+  return MessageStore(store.docIDs, store.words, store.tags,
+                      store.tagIndptr, store.tagIds, fields)
+
+
+# ------------------------------------------------------------
+# ON-DISK FORMAT
+#
+#   docids.txt, words.txt, tags.txt  - one entry per line, in ID order
+#   fields.txt                       - field names, one per line
+#   tags_indptr.npy, tags_ids.npy    - CSR tag indicators
+#   <field>_indptr.npy, <field>_ids.npy, <field>_counts.npy
+#                                    - CSR word counts per field
+
+def writeLines(fileName, values):
+  with open(fileName, 'wb') as fd:
+    for v in values:
+      fd.write(v)
+      fd.write('\n')
+
+
+def readLines(fileName):
+  with open(fileName, 'rb') as fd:
+    return [l.rstrip('\n') for l in fd]
+
+
+def messageStoreSave(store, dirName):
+  if (not os.path.isdir(dirName)):
+    os.makedirs(dirName)
+
+  writeLines(os.path.join(dirName, 'docids.txt'), store.docIDs)
+  writeLines(os.path.join(dirName, 'words.txt'),  store.words)
+  writeLines(os.path.join(dirName, 'tags.txt'),   store.tags)
+  writeLines(os.path.join(dirName, 'fields.txt'), sorted(store.fields.keys()))
+
+  np.save(os.path.join(dirName, 'tags_indptr.npy'), store.tagIndptr)
+  np.save(os.path.join(dirName, 'tags_ids.npy'),    store.tagIds)
+  for f, (indptr, ids, counts) in store.fields.iteritems():
+    np.save(os.path.join(dirName, f + '_indptr.npy'), indptr)
+    np.save(os.path.join(dirName, f + '_ids.npy'),    ids)
+    np.save(os.path.join(dirName, f + '_counts.npy'), counts)
+
+
+def messageStoreLoad(dirName, mmapMode='r'):
+  def load(name):
+    return np.load(os.path.join(dirName, name + '.npy'), mmap_mode=mmapMode)
+
+  fields = {}
+  for f in readLines(os.path.join(dirName, 'fields.txt')):
+    fields[f] = (load(f + '_indptr'), load(f + '_ids'), load(f + '_counts'))
+
+  return MessageStore(readLines(os.path.join(dirName, 'docids.txt')),
+                      readLines(os.path.join(dirName, 'words.txt')),
+                      readLines(os.path.join(dirName, 'tags.txt')),
+                      load('tags_indptr'), load('tags_ids'),
+                      fields)
+
+
+def messageStoreTagCounts(store):
+  counts = np.bincount(store.tagIds, minlength=len(store.tags))
+  return Counter({t:int(c) for t,c in zip(store.tags, counts) if c > 0})
+
+
+def messageStoreTagIndex(store):
+  docRows = np.repeat(np.arange(len(store.docIDs)), np.diff(store.tagIndptr))
+  order   = np.argsort(store.tagIds, kind='mergesort')
+  bounds  = np.searchsorted(store.tagIds[order], 
+                            np.arange(len(store.tags) + 1))
+  docIDs  = store.docIDs
+  return {t:[docIDs[r] for r in docRows[order[bounds[i]:bounds[i+1]]].tolist()]
+          for i,t in enumerate(store.tags)}
+
+
+def loadDictionaries(fileName):
+  # Load (dictMessages, dictTagCounts, dictTagIndex) from either a
+  # dataset directory or a pickle file written by createDictionaries.
+  if (os.path.isdir(fileName)):
+    store = messageStoreLoad(fileName)
+    return (store, messageStoreTagCounts(store), messageStoreTagIndex(store))
+
+  fdDicts = open(fileName, 'rb')
+  reader  = Unpickler(fdDicts)
+  dictMessages  = reader.load()
+  dictTagCounts = reader.load()
+  dictTagIndex  = reader.load()
+  fdDicts.close()
+  return (dictMessages, dictTagCounts, dictTagIndex)
@@ -0,0 +1,91 @@
+# ------------------------------------------------------------
+# modelStore.py
+#
+# Saving and loading of trained models. A model is saved as a
+# directory in the same layout as a dataset directory: numeric
+# arrays as .npy files, strings as plain text files with one
+# entry per line and scalars in a small text file. Nothing is
+# pickled, so loading is mostly reading arrays back.
+#
+# ------------------------------------------------------------
+
+import os, os.path
+
+import numpy        as np
+import scipy.sparse as sp
+
+from messageStore import writeLines, readLines
+
+
+# ------------------------------------------------------------
+# ON-DISK FORMAT
+#
+#   kind.txt      - model type, nbMulti, pmm1 or ngnb
+#   features.txt  - message fields with a model, one per line
+#   tags.txt      - tags the model was trained with
+#   <feature>/    - the model of each field
+#   network/      - the ngnb tag network
+#
+# Inside the model directories a sparse matrix X is saved as
+# X_data.npy, X_indices.npy, X_indptr.npy and X_shape.npy, and
+# scalars as "name value" lines in values.txt.
+
+def modelDirSave(dirName, kind, features, tagList):
+  if (not os.path.isdir(dirName)):
+    os.makedirs(dirName)
+
+  writeLines(os.path.join(dirName, 'kind.txt'),     [kind])
+  writeLines(os.path.join(dirName, 'features.txt'), features)
+  writeLines(os.path.join(dirName, 'tags.txt'),     tagList)
+
+
+def modelDirLoad(dirName):
+  # Returns (kind, features, tagList) of a saved model
+  kind = readLines(os.path.join(dirName, 'kind.txt'))[0]
+  return (kind, readLines(os.path.join(dirName, 'features.txt')),
+          readLines(os.path.join(dirName, 'tags.txt')))
+
+
+def modelPartDir(dirName, part):
+  partDir = os.path.join(dirName, part)
+  if (not os.path.isdir(partDir)):
+    os.makedirs(partDir)
+  return partDir
+
+
+def saveArray(dirName, name, a):
+  np.save(os.path.join(dirName, name + '.npy'), a)
+
+
+def loadArray(dirName, name):
+  return np.load(os.path.join(dirName, name + '.npy'))
+
+
+def saveCSR(dirName, name, X):
+  X = sp.csr_matrix(X)
+  saveArray(dirName, name + '_data',    X.data)
+  saveArray(dirName, name + '_indices', X.indices)
+  saveArray(dirName, name + '_indptr',  X.indptr)
+  saveArray(dirName, name + '_shape',   np.array(X.shape, dtype=np.int64))
+
+
+def loadCSR(dirName, name):
+  shape = loadArray(dirName, name + '_shape')
+  return sp.csr_matrix((loadArray(dirName, name + '_data'),
+                        loadArray(dirName, name + '_indices'),
+                        loadArray(dirName, name + '_indptr')),
+                       shape=tuple(shape.tolist()))
+
+
+def saveValues(dirName, values):
+  writeLines(os.path.join(dirName, 'values.txt'),
+             ["{} {}".format(k, repr(v)) for k,v in sorted(values.iteritems())])
+
+
+def loadValues(dirName):
+  # Scalars come back as floats
+  values = {}
+  for l in readLines(os.path.join(dirName, 'values.txt')):
+    k, v = l.split(' ', 1)
+    values[k] = float(v)
+  return values
@@ -11,87 +11,341 @@
 
 import os, os.path
 import sys
+import hashlib
 
 from collections import Counter
 from math        import log
 from math        import exp
 
-def nbMultiTrainSingle(dictMessages, messageKey, trainDocIDs, tagList):
+import numpy        as np
+import scipy.sparse as sp
+
+from docTerm      import docTermMatrix, docTermMatrixVocab, docTagMatrix
+from docTerm      import indptrNonzeros
+from messageStore import writeLines, readLines
+from modelStore   import modelDirSave, modelPartDir, saveArray, loadArray
+from modelStore   import saveCSR, loadCSR, saveValues, loadValues
+
+# Directory in which to cache the log odds of scored batches of
+# documents, or None
+LOGODDS_CACHE = None
+
+def nbMultiStatsNew(messageKey, tagList):
+  # Sufficient statistics for the model. They are additive over
+  # documents and their size depends on the vocabulary and the
+  # tags, not on the number of documents.
+  stats = {}
+  stats['messageKey']    = messageKey
+  stats['tags']          = tagList
+  stats['tagSet']        = set(tagList)
+  stats['dictVocabAll']  = Counter()
+  stats['dictVocabTag']  = {t:Counter() for t in tagList}
+  stats['countVocabAll'] = 0
+  stats['countVocabTag'] = Counter()
+  stats['countTagDocs']  = Counter()
+  stats['numDocs']       = 0
+  return stats
 
-  # Create overall dictionary dictionary
-  dictVocabAll  = Counter()
-  dictVocabTag  = {}  
-  countVocabAll = 0
-  countVocabTag = Counter()  
-  countTagDocs  = Counter()
 
-  for t in tagList:
-    dictVocabTag[t]  = Counter()
+def nbMultiStatsAdd(stats, message):
+  tags = [t for t in message['tags'] if t in stats['tagSet']]
+  text = message[stats['messageKey']]
 
-  for sid in trainDocIDs:
-    tags  = [t for t in dictMessages[sid]['tags'] if t in tagList]
-    text = dictMessages[sid][messageKey]
+  stats['numDocs'] += 1
+  dictVocabAll = stats['dictVocabAll']
+  for w,c in text.iteritems():
+    dictVocabAll[w]        += c
+    stats['countVocabAll'] += c
 
+  if (len(tags) == 0):
+    return
+
+  stats['countTagDocs'].update(tags)
+  for t in tags:
+    dictVocabTag = stats['dictVocabTag'][t]
     for w,c in text.iteritems():
-      dictVocabAll[w] += c
-      countVocabAll   += c
+      dictVocabTag[w]           += c
+      stats['countVocabTag'][t] += c
+
+
+def nbMultiCountSingle(dictMessages, messageKey, docIDs, tagList, base=None):
+  # Build the doc-term matrix X and the tag indicator matrix Y once
+  # and get the word counts for every tag from the product Y'X.
+  # When base counts are given their vocabulary is reused, so it
+  # must cover every word in the documents.
+  if (base is None):
+    X, words  = docTermMatrixVocab(dictMessages, messageKey, docIDs)
+    wordIndex = {w:i for i,w in enumerate(words)}
+  else:
+    words     = base['words']
+    wordIndex = base['wordIndex']
+    X = docTermMatrix(dictMessages, messageKey, docIDs,
+                      wordIndex, len(words))[:, :len(words)]
+  Y = docTagMatrix(dictMessages, docIDs, tagList)
 
-    if (len(tags) == 0):
-      continue
+  counts = {}
+  counts['words']        = words
+  counts['wordIndex']    = wordIndex
+  counts['countWordAll'] = np.asarray(X.sum(axis=0), dtype=float).ravel()
+  counts['countWordTag'] = sp.csr_matrix(Y.T.dot(X), dtype=float)
+  counts['countTagDocs'] = np.asarray(Y.sum(axis=0), dtype=float).ravel()
+  counts['numDocs']      = len(docIDs)
+  return counts
 
-    countTagDocs.update(tags)
-    for t in tags:
-      for w,c in text.iteritems():
-        dictVocabTag[t][w] += c
-        countVocabTag[t]   += c
 
-  # Calculate log probabilities
+def nbMultiSubtractSingle(full, part):
+  # Counts of the documents in full but not in part. Both must use
+  # the same vocabulary.
+  counts = {}
+  counts['words']        = full['words']
+  counts['wordIndex']    = full['wordIndex']
+  counts['countWordAll'] = full['countWordAll'] - part['countWordAll']
+  counts['countWordTag'] = full['countWordTag'] - part['countWordTag']
+  counts['countTagDocs'] = full['countTagDocs'] - part['countTagDocs']
+  counts['numDocs']      = full['numDocs'] - part['numDocs']
+  return counts
+
+
+def nbMultiTrainCounts(counts, messageKey, tagList):
+  # Words that no longer occur, e.g. after subtracting a fold, are
+  # dropped so the vocabulary size used for smoothing matches a
+  # model trained on the remaining documents directly.
+  keep  = np.flatnonzero(counts['countWordAll'] > 0)
+  words = counts['words']
+  countWordTag = counts['countWordTag'].tocsc()[:, keep]
+  countWordTag.eliminate_zeros()
+
+  return nbMultiModelFromCounts(messageKey, tagList,
+                                [words[i] for i in keep.tolist()],
+                                counts['countWordAll'][keep], countWordTag,
+                                counts['countTagDocs'], counts['numDocs'])
+
+
+def nbMultiTrainSingle(dictMessages, messageKey, trainDocIDs, tagList):
+  counts = nbMultiCountSingle(dictMessages, messageKey, trainDocIDs, tagList)
+  return nbMultiTrainCounts(counts, messageKey, tagList)
+
+
+def nbMultiStatsFinalize(stats):
+  tagList      = stats['tags']
+  dictVocabTag = stats['dictVocabTag']
+  words        = stats['dictVocabAll'].keys()
+  wordIndex    = {w:i for i,w in enumerate(words)}
+  countWordAll = np.array(stats['dictVocabAll'].values(), dtype=float)
+  countTagDocs = np.array([stats['countTagDocs'][t] for t in tagList], 
+                          dtype=float)
+
+  rows = []
+  cols = []
+  data = []
+  for i,t in enumerate(tagList):
+    rows.extend([i] * len(dictVocabTag[t]))
+    cols.extend([wordIndex[w] for w in dictVocabTag[t].iterkeys()])
+    data.extend(dictVocabTag[t].itervalues())
+  countWordTag = sp.coo_matrix((np.array(data, dtype=float), (rows, cols)),
+                               shape=(len(tagList), len(words)))
+
+  return nbMultiModelFromCounts(stats['messageKey'], tagList, words, 
+                                countWordAll, countWordTag, 
+                                countTagDocs, stats['numDocs'])
+
+
+def nbMultiModelFromCounts(messageKey, tagList, words, 
+                           countWordAll, countWordTag, 
+                           countTagDocs, numDocs, scorer=None):
+  # The model keeps the training counts in arrays indexed by word ID
+  # and tag ID: countWordAll holds the total count of each word, 
+  # countWordTag is a sparse words x tags matrix of per tag counts 
+  # and countTagDocs the number of documents with each tag. The 
+  # "not tag" counts are never stored since they are the totals 
+  # minus the per tag counts.
   model = {}
-  model['tags'] = tagList
+  model['tags']          = tagList
   model['messageKey']    = messageKey
-  model['lpWordAll']     = {}
-  model['lpWordTag']     = {}
-  model['lpWordNotTag']  = {}
-  model['lpPriorTag']    = Counter(tagList)
-  model['lpPriorNotTag'] = Counter(tagList)  
-
-  for t in tagList:
-    model['lpWordTag'][t] = {}
-    model['lpWordNotTag'][t] = {}
-
-  # Tag priors
-  numDocs    = len(trainDocIDs)
-  logNumDocs = log(numDocs)
-  for t,c in countTagDocs.iteritems():
-    model['lpPriorTag'][t] = log(c) - logNumDocs
-    if (c < numDocs):
-      model['lpPriorNotTag'][t] = log(numDocs - c) - logNumDocs
-    else:
-      model['lpPriorNotTag'][t] = 0
-
-  # Smoothing parameter for words not in the vocabulary
-  smooth = len(dictVocabAll)
-  model['lpSmooth'] = log(1) - log(smooth)
-
-  # Calculate per tag positive and negative probabilities
-  for w,c in dictVocabAll.iteritems():
-    model['lpWordAll'][w] = log(c+1) - log(countVocabAll + smooth)
-
-    for t in tagList:
-      if (w in dictVocabTag[t]):
-        wTagCount = dictVocabTag[t][w]
-        wTagTotal = countVocabTag[t]
-        model['lpWordTag'][t][w] = log(wTagCount + 1) - log(wTagTotal + smooth)
-      else:
-        wTagCount = 0
-        wTagTotal = 0
-
-      model['lpWordNotTag'][t][w] = (log(c - wTagCount + 1) - 
-                                     log(countVocabAll - wTagTotal + smooth))
+  model['words']         = list(words)
+  model['wordIndex']     = {w:i for i,w in enumerate(words)}
+  model['tagIndex']      = {t:i for i,t in enumerate(tagList)}
+  model['countWordAll']  = np.asarray(countWordAll, dtype=float)
+  model['countWordTag']  = sp.csr_matrix(countWordTag.T, dtype=float)
+  model['countTagDocs']  = np.asarray(countTagDocs, dtype=float)
+  model['countVocabAll'] = model['countWordAll'].sum()
+  model['countVocabTag'] = np.asarray(model['countWordTag'].sum(axis=0)).ravel()
+  model['numDocs']       = numDocs
+  model['staleWords']    = set()
 
+  # A saved scorer only needs its totals recomputed
+  if (scorer is None):
+    scorer = nbMultiCompile(model)
+  else:
+    nbMultiCompileTotals(model, scorer)
+  model['scorer'] = scorer
   return model
 
 
+def nbMultiWordTerms(model, wordIDs):
+  # Per word parts of the log probabilities for the given words.
+  # They only depend on the counts of each word, so they stay valid
+  # when other words or the totals change:
+  #
+  #   numTag[w,t]    = log(c(w,t) + 1)
+  #   numNotAdj[w,t] = log(c(w) - c(w,t) + 1) - log(c(w) + 1)
+  #   numBase[w]     = log(c(w) + 1)
+  #
+  # numTag and numNotAdj are only defined where c(w,t) > 0 and are
+  # returned as (rows, tags, values) coordinates.
+  countWordAll = model['countWordAll']
+  counts = model['countWordTag'][wordIDs].tocoo()
+  w = np.asarray(wordIDs)[counts.row]
+  t = counts.col
+  c = counts.data
+
+  numTag    = np.log(c + 1)
+  numNotAdj = np.log(countWordAll[w] - c + 1) - np.log(countWordAll[w] + 1)
+  numBase   = np.log(countWordAll[wordIDs] + 1)
+  return w, t, numTag, numNotAdj, numBase
+
+
+def nbMultiCompileTotals(model, scorer):
+  # Parts of the log probabilities that depend on the totals. With
+  # V words, N words overall and N(t) words in documents with tag t:
+  #
+  #   log P(w|t)     = numTag - log(N(t) + V)  or  lpSmooth
+  #   log P(w|not t) = numBase + numNotAdj - log(N - N(t) + V)
+  #                    or  numBase - log(N + V)
+  #
+  # depending on whether w was seen with t. Out of vocabulary words
+  # get lpSmooth = -log(V) on both sides.
+  countTagDocs  = model['countTagDocs']
+  countVocabAll = model['countVocabAll']
+  countVocabTag = model['countVocabTag']
+  numDocs       = model['numDocs']
+  smooth        = len(model['words'])
+
+  scorer['oov']       = smooth
+  scorer['lpSmooth']  = log(1) - log(smooth)
+  scorer['logDenAll'] = log(countVocabAll + smooth)
+  scorer['logDenTag'] = np.log(countVocabTag + smooth)
+  scorer['logDenNot'] = np.log(countVocabAll - countVocabTag + smooth)
+
+  # Tag priors. Tags without documents keep the value that the
+  # original Counter based priors defaulted to.
+  lpPriorTag    = np.ones(len(countTagDocs))
+  lpPriorNotTag = np.ones(len(countTagDocs))
+  seen          = countTagDocs > 0
+  logNumDocs    = log(numDocs)
+  lpPriorTag[seen]    = np.log(countTagDocs[seen]) - logNumDocs
+  lpPriorNotTag[seen] = 0
+  notAll = seen & (countTagDocs < numDocs)
+  lpPriorNotTag[notAll] = np.log(numDocs - countTagDocs[notAll]) - logNumDocs
+
+  scorer['lpPriorTag']    = lpPriorTag
+  scorer['lpPriorNotTag'] = lpPriorNotTag
+
+
+def nbMultiCompile(model):
+  # Derive the scoring arrays from the counts. The per word terms
+  # are stored as sparse (words+1) x tags matrices whose last row,
+  # for words outside the vocabulary, is empty.
+  smooth  = len(model['words'])
+  numTags = len(model['tags'])
+  w, t, numTag, numNotAdj, numBase = nbMultiWordTerms(model, np.arange(smooth))
+
+  scorer = {}
+  scorer['numTag']    = sp.csr_matrix((numTag, (w, t)), 
+                                      shape=(smooth + 1, numTags))
+  scorer['numNotAdj'] = sp.csr_matrix((numNotAdj, (w, t)), 
+                                      shape=(smooth + 1, numTags))
+  scorer['numBase']   = np.append(numBase, 0)
+  nbMultiCompileTotals(model, scorer)
+  return scorer
+
+
+def nbMultiRefresh(model):
+  # Recompute the per word terms of the words whose counts changed
+  # since the last refresh and the cheap per tag totals. Rows for
+  # words added since then start out empty.
+  scorer  = model['scorer']
+  smooth  = len(model['words'])
+  numTags = len(model['tags'])
+  stale   = np.array(sorted(model['staleWords']), dtype=np.int64)
+  w, t, numTag, numNotAdj, numBase = nbMultiWordTerms(model, stale)
+
+  keep = np.ones(smooth + 1)
+  keep[stale] = 0
+  keep = sp.diags(keep)
+  for key, values in [('numTag', numTag), ('numNotAdj', numNotAdj)]:
+    old = nbMultiResizeRows(scorer[key], smooth + 1)
+    new = sp.csr_matrix((values, (w, t)), shape=(smooth + 1, numTags))
+    scorer[key] = (keep.dot(old) + new).tocsr()
+    scorer[key].eliminate_zeros()
+
+  oldBase = scorer['numBase']
+  scorer['numBase'] = np.zeros(smooth + 1)
+  scorer['numBase'][:len(oldBase) - 1] = oldBase[:-1]
+  scorer['numBase'][stale] = numBase
+  nbMultiCompileTotals(model, scorer)
+  scorer.pop('columns', None)
+  model['staleWords'] = set()
+
+
+def nbMultiResizeRows(X, numRows):
+  # Grow a CSR matrix to numRows rows by appending empty rows
+  indptr = np.append(X.indptr, np.repeat(X.indptr[-1], numRows - X.shape[0]))
+  return sp.csr_matrix((X.data, X.indices, indptr), shape=(numRows, X.shape[1]))
+
+
+def nbMultiPartialFit(model, newDocs):
+  # Fold new messages into a trained model. Only the counts are 
+  # updated here, in time proportional to the new messages; the log
+  # probabilities of the affected words are refreshed the next time
+  # the model is used. Tags that the model was not trained with are
+  # ignored.
+  f         = model['messageKey']
+  words     = model['words']
+  wordIndex = model['wordIndex']
+  tagIndex  = model['tagIndex']
+  numTags   = len(model['tags'])
+  oldSmooth = len(words)
+  model.pop('statsKey', None)
+
+  wordCounts = Counter()
+  tagDocs    = Counter()
+  numNewDocs = 0
+  rows = []
+  cols = []
+  data = []
+  for message in newDocs:
+    numNewDocs += 1
+    tagIDs = [tagIndex[t] for t in message['tags'] if t in tagIndex]
+    tagDocs.update(tagIDs)
+
+    for w,c in message[f].iteritems():
+      i = wordIndex.get(w)
+      if (i is None):
+        i = wordIndex[w] = len(words)
+        words.append(w)
+      wordCounts[i] += c
+      for j in tagIDs:
+        rows.append(i)
+        cols.append(j)
+        data.append(c)
+
+  smooth = len(words)
+  delta  = sp.csr_matrix((np.array(data, dtype=float), (rows, cols)),
+                         shape=(smooth, numTags))
+  model['countWordTag'] = (nbMultiResizeRows(model['countWordTag'], smooth) + 
+                           delta).tocsr()
+
+  model['countWordAll'] = np.append(model['countWordAll'], 
+                                    np.zeros(smooth - oldSmooth))
+  model['countWordAll'][wordCounts.keys()] += wordCounts.values()
+  model['countVocabAll'] += sum(wordCounts.itervalues())
+  model['countVocabTag'] += np.asarray(delta.sum(axis=0)).ravel()
+  model['countTagDocs'][tagDocs.keys()] += tagDocs.values()
+  model['numDocs'] += numNewDocs
+  model['staleWords'].update(wordCounts.iterkeys())
+  return model
+
 
 def nbMultiTrain(dictMessages, features, trainDocIDs, tagList):
   models = {}
@@ -101,40 +355,313 @@ def nbMultiTrain(dictMessages, features, trainDocIDs, tagList):
   return models
 
 
+def nbMultiCount(dictMessages, features, docIDs, tagList, base=None):
+  # Training counts for each feature. Counts are additive, so the
+  # counts of a training set can be had by subtracting those of the
+  # held out documents from the counts of the whole data set, see
+  # nbMultiSubtract and runKfold.
+  counts = {}
+  for f in features:
+    counts[f] = nbMultiCountSingle(dictMessages, f, docIDs, tagList,
+                                   None if base is None else base[f])
+  return counts
+
+
+def nbMultiSubtract(full, part, features):
+  return {f:nbMultiSubtractSingle(full[f], part[f]) for f in features}
+
+
+def nbMultiTrainFromCounts(counts, features, tagList):
+  models = {}
+  for f in features:
+    models[f] = nbMultiTrainCounts(counts[f], f, tagList)
+  return models
+
+
+def nbMultiTrainStream(messages, features, tagList):
+  # Train from an iterable of messages, e.g. a generator reading
+  # CSV files, without holding the data set in memory.
+  stats = {f:nbMultiStatsNew(f, tagList) for f in features}
+  for message in messages:
+    for f in features:
+      nbMultiStatsAdd(stats[f], message)
+
+  models = {}
+  for f in features:
+    models[f] = nbMultiStatsFinalize(stats[f])
+  return models
+
+
+def nbMultiScorer(model):
+  scorer = model.get('scorer')
+  if (scorer is None):
+    scorer = model['scorer'] = nbMultiCompile(model)
+  elif (len(model['staleWords']) > 0):
+    nbMultiRefresh(model)
+  return scorer
+
+
+def nbMultiLogOddsMatrix(model, X):
+  # Log odds of every tag for each row of the doc-term matrix X,
+  # whose columns follow the model's word IDs plus one column for
+  # words outside the vocabulary.
+  #
+  # NB - the unconditional probability of each word is
+  #      not calculated or considered since it is a
+  #      constant between the in-tag and out-of-tag 
+  #      probabilities.
+  scorer    = nbMultiScorer(model)
+  numTag    = scorer['numTag']
+  docLength = np.asarray(X.sum(axis=1))
+  oovCount  = X[:, scorer['oov']].toarray()
+
+  # Count of each document's words that were seen with each tag
+  seen = X.dot(sp.csr_matrix((np.ones(numTag.nnz), numTag.indices, 
+                              numTag.indptr), shape=numTag.shape)).toarray()
+
+  pTag    = (scorer['lpPriorTag'] + X.dot(numTag).toarray() - 
+             seen * scorer['logDenTag'] + 
+             (docLength - seen) * scorer['lpSmooth'])
+  pNotTag = (scorer['lpPriorNotTag'] + X.dot(scorer['numBase'])[:, np.newaxis] - 
+             (docLength - oovCount) * scorer['logDenAll'] + 
+             oovCount * scorer['lpSmooth'] + 
+             X.dot(scorer['numNotAdj']).toarray() - 
+             seen * (scorer['logDenNot'] - scorer['logDenAll']))
+  return pTag - pNotTag
+
+
 def nbMultiPredictLogOdds(models, f, dictText, tagList): 
-  model   = models[f]
-  pTag    = Counter(tagList)
-  pNotTag = Counter(tagList)
-  for t in tagList:
-    pTag[t]    += model['lpPriorTag'][t]
-    pNotTag[t] += model['lpPriorNotTag'][t]
-
-  for w,c in dictText.iteritems():
-    for t in tagList:  
-      # NB - the unconditional probability of each word is
-      #      not calculated or considered since it is a
-      #      constant between the in-tag and out-of-tag 
-      #      probabilities.
-      if (w in model['lpWordTag'][t]):
-        pTag[t]    += c * (model['lpWordTag'][t][w])
-      else:
-        pTag[t] += c * (model['lpSmooth'])
-
-      if (w in model['lpWordNotTag'][t]):
-        pNotTag[t] += c * (model['lpWordNotTag'][t][w])
-      else:
-        pNotTag[t] += c * (model['lpSmooth'])
-
-  tagLogOdds = {t:(pTag[t] - pNotTag[t]) for t in tagList}
+  model     = models[f]
+  scorer    = nbMultiScorer(model)
+  wordIndex = model['wordIndex']
+  oov       = scorer['oov']
+  numTags   = len(model['tags'])
+  tagList   = list(tagList)
+  cols      = [model['tagIndex'][t] for t in tagList]
+
+  # Rows in order keep the lookups in nbMultiTagLogOdds sorted
+  rows   = np.array([wordIndex.get(w, oov) for w in dictText.iterkeys()],
+                    dtype=np.int64)
+  counts = np.array(dictText.values(), dtype=float)
+  order  = np.argsort(rows, kind='mergesort')
+  rows   = rows[order]
+  counts = counts[order]
+  docLength = counts.sum()
+  oovCount  = counts[rows == oov].sum()
+
+  # Same sums as nbMultiLogOddsMatrix, gathering the document's rows 
+  # of the sparse per word terms directly.
+  numTag      = scorer['numTag']
+  nz, lengths = indptrNonzeros(numTag.indptr, rows)
+  tagIDs      = numTag.indices[nz]
+  weights     = np.repeat(counts, lengths)
+  seen        = np.bincount(tagIDs, weights, minlength=numTags)
+  sumNumTag   = np.bincount(tagIDs, weights * numTag.data[nz], minlength=numTags)
+
+  numNotAdj   = scorer['numNotAdj']
+  nz, lengths = indptrNonzeros(numNotAdj.indptr, rows)
+  sumNotAdj   = np.bincount(numNotAdj.indices[nz], 
+                            np.repeat(counts, lengths) * numNotAdj.data[nz],
+                            minlength=numTags)
+
+  pTag    = (scorer['lpPriorTag'] + sumNumTag - 
+             seen * scorer['logDenTag'] + 
+             (docLength - seen) * scorer['lpSmooth'])
+  pNotTag = (scorer['lpPriorNotTag'] + counts.dot(scorer['numBase'][rows]) - 
+             (docLength - oovCount) * scorer['logDenAll'] + 
+             oovCount * scorer['lpSmooth'] + sumNotAdj - 
+             seen * (scorer['logDenNot'] - scorer['logDenAll']))
+
+  tagLogOdds = dict(zip(tagList, (pTag - pNotTag)[cols].tolist()))
   return tagLogOdds
 
 
+def nbMultiColumns(scorer):
+  # Column oriented copies of the per word terms for scoring single
+  # tags, with the sorted (tag, word row) key of every entry so the
+  # entries of many tags can be looked up in one search. Dropped by
+  # nbMultiRefresh and rebuilt on the next use.
+  columns = scorer.get('columns')
+  if (columns is None):
+    columns = scorer['columns'] = {}
+    for key in ['numTag', 'numNotAdj']:
+      X = scorer[key].tocsc()
+      X.sort_indices()
+      tagIDs = np.repeat(np.arange(X.shape[1]), np.diff(X.indptr))
+      columns[key] = (tagIDs * X.shape[0] + X.indices, X.data)
+  return columns
+
+
+def nbMultiDocTerms(model, dictText):
+  # Parts of a document's log odds shared by all tags
+  scorer    = nbMultiScorer(model)
+  wordIndex = model['wordIndex']
+  oov       = scorer['oov']
+
+  # Rows in order keep the lookups in nbMultiTagLogOdds sorted
+  rows   = np.array([wordIndex.get(w, oov) for w in dictText.iterkeys()],
+                    dtype=np.int64)
+  counts = np.array(dictText.values(), dtype=float)
+  order  = np.argsort(rows, kind='mergesort')
+  rows   = rows[order]
+  counts = counts[order]
+
+  doc = {}
+  doc['rows']      = rows
+  doc['counts']    = counts
+  doc['docLength'] = counts.sum()
+  doc['oovCount']  = counts[rows == oov].sum()
+  doc['sumBase']   = counts.dot(scorer['numBase'][rows])
+  return doc
+
+
+def nbMultiTagLogOdds(model, doc, tagIDs):
+  # Log odds of only the given tag IDs for a document from 
+  # nbMultiDocTerms. Only the entries of the given tags for the 
+  # document's words are looked up, so the cost does not depend on
+  # the number of tags in the model.
+  scorer  = nbMultiScorer(model)
+  columns = nbMultiColumns(scorer)
+  rows    = doc['rows']
+  counts  = doc['counts']
+  order   = np.argsort(tagIDs, kind='mergesort')
+  tagIDs  = np.asarray(tagIDs, dtype=np.int64)[order]
+
+  # Keys of every (tag, document word) pair, looked up in order among
+  # the keys of the non-zero entries
+  numRows = scorer['numTag'].shape[0]
+  queries = (tagIDs[:,None] * numRows + rows[None,:]).ravel()
+  weights = np.tile(counts, len(tagIDs))
+  sums = {}
+  for key, (keys, data) in columns.iteritems():
+    pos  = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    hit  = keys[pos] == queries
+    sums[key] = (np.where(hit, weights * data[pos], 0).
+                 reshape(len(tagIDs), len(rows)).sum(axis=1))
+    if (key == 'numTag'):
+      seen = (np.where(hit, weights, 0).
+              reshape(len(tagIDs), len(rows)).sum(axis=1))
+
+  docLength = doc['docLength']
+  oovCount  = doc['oovCount']
+  pTag    = (scorer['lpPriorTag'][tagIDs] + sums['numTag'] - 
+             seen * scorer['logDenTag'][tagIDs] + 
+             (docLength - seen) * scorer['lpSmooth'])
+  pNotTag = (scorer['lpPriorNotTag'][tagIDs] + doc['sumBase'] - 
+             (docLength - oovCount) * scorer['logDenAll'] + 
+             oovCount * scorer['lpSmooth'] + sums['numNotAdj'] - 
+             seen * (scorer['logDenNot'][tagIDs] - scorer['logDenAll']))
+
+  logOdds = np.empty(len(tagIDs))
+  logOdds[order] = pTag - pNotTag
+  return logOdds
+
+
 def nbMultiPredict(models, f, dictText, tagList): 
   tagLogOdds     = nbMultiPredictLogOdds(models, f, dictText, tagList)
   tagPredictions = [ t for t,lo in tagLogOdds.iteritems() if lo >=0]
-  return tagPredictions 
+  return tagPredictions
+
+
+def nbMultiStatsKey(model):
+  # Hash of the training counts, which determine all of the model's
+  # log odds. Kept in the model until its counts change.
+  key = model.get('statsKey')
+  if (key is None):
+    h = hashlib.sha1(repr((model['messageKey'], model['tags'], 
+                           model['words'], model['numDocs'])))
+    countWordTag = model['countWordTag']
+    for a in [model['countWordAll'], model['countTagDocs'], 
+              countWordTag.data, countWordTag.indices, countWordTag.indptr]:
+      h.update(np.ascontiguousarray(a).tostring())
+    key = model['statsKey'] = h.hexdigest()
+  return key
+
+
+def nbMultiLogOddsCached(model, X):
+  # nbMultiLogOddsMatrix backed by files in LOGODDS_CACHE, keyed by
+  # the model's counts and the doc-term matrix. A batch scored before
+  # is memory mapped from its .npy file instead of scored again.
+  if (LOGODDS_CACHE is None):
+    return nbMultiLogOddsMatrix(model, X)
+
+  h = hashlib.sha1(nbMultiStatsKey(model))
+  for a in [X.data, X.indices, X.indptr]:
+    h.update(np.ascontiguousarray(a).tostring())
+  cacheFile = os.path.join(LOGODDS_CACHE, h.hexdigest() + '.npy')
+  if (os.path.exists(cacheFile)):
+    return np.load(cacheFile, mmap_mode='r')
+
+  # Written under a temporary name and renamed, so concurrent runs
+  # never see a partial file
+  logOdds = nbMultiLogOddsMatrix(model, X)
+  if (not os.path.isdir(LOGODDS_CACHE)):
+    try:
+      os.makedirs(LOGODDS_CACHE)
+    except OSError:
+      if (not os.path.isdir(LOGODDS_CACHE)):
+        raise
+  tmpFile = "{}.{}.tmp".format(cacheFile, os.getpid())
+  with open(tmpFile, 'wb') as fd:
+    np.save(fd, logOdds)
+  os.rename(tmpFile, cacheFile)
+  return logOdds
 
 
+def nbMultiPredictLogOddsBatch(models, f, dictMessages, docIDs, tagList):
+  # Score many documents at once. Returns a len(docIDs) x len(tagList)
+  # array of log odds with rows in docIDs order.
+  model = models[f]
+  cols  = [model['tagIndex'][t] for t in tagList]
+  X     = docTermMatrix(dictMessages, f, docIDs, 
+                        model['wordIndex'], len(model['wordIndex']))
+  return nbMultiLogOddsCached(model, X)[:, cols]
 
 
-          
+def nbMultiPredictBatch(models, f, dictMessages, docIDs, tagList):
+  tagList = list(tagList)
+  logOdds = nbMultiPredictLogOddsBatch(models, f, dictMessages, 
+                                       docIDs, tagList)
+  return [[tagList[i] for i in np.flatnonzero(lo >= 0)] for lo in logOdds]
+
+
+def nbMultiSaveSingle(model, dirName):
+  # Save the counts along with the per word terms, so loading does
+  # not have to compile the model again
+  scorer = nbMultiScorer(model)
+  writeLines(os.path.join(dirName, 'words.txt'), model['words'])
+  writeLines(os.path.join(dirName, 'tags.txt'),  model['tags'])
+  saveArray(dirName, 'countWordAll', model['countWordAll'])
+  saveArray(dirName, 'countTagDocs', model['countTagDocs'])
+  saveCSR(dirName, 'countWordTag', model['countWordTag'])
+  saveCSR(dirName, 'numTag',       scorer['numTag'])
+  saveCSR(dirName, 'numNotAdj',    scorer['numNotAdj'])
+  saveArray(dirName, 'numBase',    scorer['numBase'])
+  saveValues(dirName, {'numDocs': model['numDocs']})
+
+
+def nbMultiLoadSingle(dirName, messageKey):
+  scorer = {}
+  scorer['numTag']    = loadCSR(dirName, 'numTag')
+  scorer['numNotAdj'] = loadCSR(dirName, 'numNotAdj')
+  scorer['numBase']   = loadArray(dirName, 'numBase')
+  return nbMultiModelFromCounts(messageKey, 
+                                readLines(os.path.join(dirName, 'tags.txt')),
+                                readLines(os.path.join(dirName, 'words.txt')),
+                                loadArray(dirName, 'countWordAll'),
+                                loadCSR(dirName, 'countWordTag').T,
+                                loadArray(dirName, 'countTagDocs'),
+                                int(loadValues(dirName)['numDocs']), scorer)
+
+
+def nbMultiSave(models, features, tagList, dirName):
+  modelDirSave(dirName, 'nbMulti', features, tagList)
+  for f in features:
+    nbMultiSaveSingle(models[f], modelPartDir(dirName, f))
+
+
+def nbMultiLoad(dirName, features):
+  models = {}
+  for f in features:
+    models[f] = nbMultiLoadSingle(os.path.join(dirName, f), f)
+  return models
@@ -9,13 +9,33 @@
 #
 # ------------------------------------------------------------
 
+import os, os.path
+import sys
+import time
+import hashlib
 import itertools
 import networkx as nx
 import numpy    as np 
+import scipy.sparse as sp
 import pdb
+import cPickle as pickle
 
 from collections   import Counter
 from nbMultinomial import *
+from messageStore  import writeLines, readLines
+from modelStore    import modelDirSave, modelPartDir, saveArray, loadArray
+from modelStore    import saveCSR, loadCSR, saveValues, loadValues
+
+
+# TUNABLES
+SEARCH_LIMIT   = 5
+DAMPING_FACTOR = 0.7
+
+# Number of pivot nodes for approximate closeness and betweenness,
+# None for exact scores, and an optional directory in which to cache
+# centrality scores across runs.
+CENTRALITY_PIVOTS = None
+CENTRALITY_CACHE  = None
 
 
 # From Python itertools documentation
@@ -28,65 +48,190 @@ def powerset(iterable, max=None):
 
 
 def ngnbGetAbovePercentile(g, fn, q=90, **kwargs):
-   scores = fn(g, **kwargs)
+   return ngnbAbovePercentile(fn(g, **kwargs), q)
+
+
+def ngnbAbovePercentile(scores, q=90):
    values = np.array([v for v in scores.itervalues()])      
    thresh = np.percentile(values, q)
    nodes = [n for n,v in scores.iteritems() if v >= thresh]   
    return nodes
 
 
-def ngnbCreateNetwork(dictMessages, trainIDs, tagList):
-  nodeCounts   = Counter()
-  edgeCounts   = Counter()
-  maxNodeCount = 0
-  maxEdgeCount = 0
-
-  g = nx.Graph()
-  g.add_nodes_from(tagList)
-  for sid in trainIDs:
-    tags  = sorted([t for t in dictMessages[sid]['tags'] if t in tagList])
-
-    g.add_nodes_from(tags)
-    nodeCounts.update(tags)
-
-    if (len(tags) > 1):
-      for n1,n2 in itertools.combinations(tags,2):
-        g.add_edge(n1,n2)
-        edgeCounts[(n1,n2)] += 1
-    else:
-      # Add a self loop to track how many times node appears alone
-      g.add_edge(tags[0],tags[0])
-      edgeCounts[(tags[0],tags[0])] += 1
-
+def ngnbPivots(g, k, key):
+  # k pivot nodes drawn with a seed taken from the network's key so
+  # the same network always gets the same pivots.
+  rnd = np.random.RandomState(int(key[:8], 16))
+  nodes = g.nodes()
+  return [nodes[i] for i in rnd.choice(len(nodes), k, replace=False)]
+
+
+def ngnbApproxCloseness(g, pivots, distance=None):
+  # Closeness estimated from the distances to the pivots only: the
+  # inverse of the mean distance to the reachable pivots, scaled by
+  # the fraction of pivots that are reachable, as the normalized 
+  # exact closeness is scaled by the fraction of reachable nodes.
+  totals  = Counter()
+  reached = Counter()
+  for p in pivots:
+    for n, d in nx.single_source_dijkstra_path_length(g, p, 
+                                                     weight=distance).iteritems():
+      if (n != p):
+        totals[n]  += d
+        reached[n] += 1
+
+  pivotSet  = set(pivots)
+  closeness = {}
   for n in g.nodes_iter():
-    maxNodeCount = max(maxNodeCount, nodeCounts[n])
-    g.node[n]['count'] = nodeCounts[n]
+    others = len(pivots) - (1 if n in pivotSet else 0)
+    if ((totals[n] > 0) and (others > 0)):
+      closeness[n] = (float(reached[n]) / totals[n]) * (float(reached[n]) / others)
+    else:
+      closeness[n] = 0.0
+  return closeness
+
+
+def ngnbApproxBetweenness(g, pivots, weight=None):
+  # Betweenness from the shortest paths starting at the pivots only,
+  # scaled up to all sources.
+  scores = nx.betweenness_centrality_subset(g, pivots, g.nodes(), weight=weight)
+  scale  = float(len(g)) / len(pivots)
+  return {n:v * scale for n,v in scores.iteritems()}
+
+
+def ngnbNetworkKey(g, pivots):
+  # Hash of the network's node and edge counts, which determine
+  # all of the centrality scores, and of the pivot setting.
+  edges = sorted([tuple(sorted([n1,n2])) + (attrs['count'],) 
+                  for n1,n2,attrs in g.edges_iter(data=True)])
+  nodes = sorted([(n, attrs['count']) for n,attrs in g.nodes_iter(data=True)])
+  return hashlib.sha1(repr((nodes, edges, pivots))).hexdigest()
+
+
+# Centrality scores of the networks seen so far, by network key
+centralityCache = {}
+
+
+def ngnbCentralities(g):
+  # Degree, closeness and betweenness scores of the network along
+  # with the seconds each took. With CENTRALITY_PIVOTS set, closeness
+  # and betweenness are estimated from that many pivot nodes; fewer
+  # than one pivot, or at least as many as nodes, gives exact scores.
+  # Results are cached by network key, in memory and in
+  # CENTRALITY_CACHE if it names a directory.
+  k = CENTRALITY_PIVOTS
+  if ((k is not None) and ((k < 1) or (k >= len(g)))):
+    k = None
+  key = ngnbNetworkKey(g, k)
+
+  if (key in centralityCache):
+    return centralityCache[key]
+
+  cacheFile = None
+  if (CENTRALITY_CACHE is not None):
+    cacheFile = os.path.join(CENTRALITY_CACHE, key + '.pk')
+    if (os.path.exists(cacheFile)):
+      with open(cacheFile, 'rb') as fd:
+        centralityCache[key] = pickle.load(fd)
+      return centralityCache[key]
+
+  if (k is None):
+    fns = [('degree',      nx.degree, {}),
+           ('closeness',   nx.closeness_centrality, {'distance': 'distance'}),
+           ('betweenness', nx.betweenness_centrality, {'weight': 'distance'})]
+  else:
+    pivots = ngnbPivots(g, k, key)
+    fns = [('degree',      nx.degree, {}),
+           ('closeness',   ngnbApproxCloseness, 
+            {'pivots': pivots, 'distance': 'distance'}),
+           ('betweenness', ngnbApproxBetweenness, 
+            {'pivots': pivots, 'weight': 'distance'})]
+
+  scores = {}
+  times  = {}
+  for name, fn, kwargs in fns:
+    startTime    = time.time()
+    scores[name] = fn(g, **kwargs)
+    times[name]  = time.time() - startTime
+
+  centralityCache[key] = (scores, times)
+  if (cacheFile is not None):
+    # Written under a temporary name and renamed, so concurrent -j
+    # workers never load a partial pickle
+    if (not os.path.isdir(CENTRALITY_CACHE)):
+      try:
+        os.makedirs(CENTRALITY_CACHE)
+      except OSError:
+        if (not os.path.isdir(CENTRALITY_CACHE)):
+          raise
+    tmpFile = "{}.{}.tmp".format(cacheFile, os.getpid())
+    with open(tmpFile, 'wb') as fd:
+      pickle.dump(centralityCache[key], fd, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpFile, cacheFile)
+  return centralityCache[key]
+
+
+def ngnbCountNetwork(dictMessages, trainIDs, tagList):
+  # Count how often each tag and each pair of tags occurs, in tagList
+  # order, from the tag indicator matrix Y of the documents: the node
+  # counts are the column sums of Y and the pair counts the upper 
+  # triangle of Y'Y. Tags that occur alone are counted as a self 
+  # loop. A tag listed m times by a document with other tags pairs
+  # with itself m(m-1)/2 times, as in the original combinations.
+  # Documents without any tag in tagList are not counted.
+  Y         = docTagMatrix(dictMessages, trainIDs, tagList)
+  docLength = np.asarray(Y.sum(axis=1)).ravel()
+  nodeCounts = np.asarray(Y.sum(axis=0)).ravel()
+
+  pairs = sp.triu(Y.T.dot(Y), k=1)
+  multi = Y[np.flatnonzero(docLength > 1)]
+  alone = Y[np.flatnonzero(docLength == 1)]
+  loops = (np.asarray(alone.sum(axis=0)).ravel() + 
+           np.asarray((multi.multiply(multi) - multi).sum(axis=0)).ravel() / 2)
+
+  edgeCounts = (pairs + sp.diags(loops, 0)).tocsr()
+  return nodeCounts, edgeCounts
+
+
+def ngnbBuildNetwork(nodeCounts, edgeCounts, tagList):
+  # Build the tag network from node counts and the upper triangle
+  # of the pair counts, both in tagList order.
+  edges = sp.coo_matrix(edgeCounts)
+  keep  = edges.data > 0
+  rows  = edges.row[keep].tolist()
+  cols  = edges.col[keep].tolist()
+  data  = edges.data[keep].astype(int).tolist()
+  maxEdgeCount = max(data) if (len(data) > 0) else 0
 
-  for e in [sorted([e1,e2]) for e1,e2 in g.edges_iter()]:
-    maxEdgeCount = max(maxEdgeCount, edgeCounts[(e[0],e[1])])
-    g.edge[e[0]][e[1]]['count'] = edgeCounts[(e[0],e[1])]
+  g = nx.Graph()
+  g.add_nodes_from([(t, {'count': int(c)}) for t,c in zip(tagList, nodeCounts)])
 
   # Add a distance attribute to edges
-  for e in [sorted([e1,e2]) for e1,e2 in g.edges_iter()]:
-    g.edge[e[0]][e[1]]['distance'] = (maxEdgeCount - 
-                                      (float(edgeCounts[(e[0],e[1])])/maxEdgeCount)*maxEdgeCount + 
-                                      1)
+  g.add_edges_from([(tagList[i], tagList[j], 
+                     {'count': c, 
+                      'distance': (maxEdgeCount - 
+                                   (float(c)/maxEdgeCount)*maxEdgeCount + 
+                                   1)})
+                    for i,j,c in zip(rows, cols, data)])
   return g
 
 
+def ngnbCreateNetwork(dictMessages, trainIDs, tagList):
+  nodeCounts, edgeCounts = ngnbCountNetwork(dictMessages, trainIDs, tagList)
+  return ngnbBuildNetwork(nodeCounts, edgeCounts, tagList)
+
+
+def ngnbAddNetwork(models, g, countTrainDocs):
+  # Save top nodes based on centrality scores for possible use
+  # during prediction.
+  startTime      = time.time()
+  scores, times  = ngnbCentralities(g)
+  centralityTime = time.time() - startTime
 
-def ngnbTrain(dictMessages, f, trainIDs, tagList):
-  # Create graph from tags and save top nodes based on centrality
-  # scores for possible use during prediction.
-  g = ngnbCreateNetwork(dictMessages, trainIDs, tagList)
   topNodes = set()
-  topNodes |= set(ngnbGetAbovePercentile(g, 
-                                         nx.degree, q=90))
-  topNodes |= set(ngnbGetAbovePercentile(g, 
-                                         nx.closeness_centrality, 
-                                         q=90, distance='distance'))
-  topNodes |= set(ngnbGetAbovePercentile(g, nx.betweenness_centrality, 
-                                         q=90, weight='distance'))
+  topNodes |= set(ngnbAbovePercentile(scores['degree'], q=90))
+  topNodes |= set(ngnbAbovePercentile(scores['closeness'], q=90))
+  topNodes |= set(ngnbAbovePercentile(scores['betweenness'], q=90))
 
   if (len(topNodes) == 0):
     pdb.set_trace()
@@ -99,136 +244,364 @@ def ngnbTrain(dictMessages, f, trainIDs, tagList):
   for e in g.edges():
     countEdgeTotal += g.edge[e[0]][e[1]]['count']
 
-  # Train binary relevance multinomial model
-  models = nbMultiTrain(dictMessages, f, trainIDs, tagList)
+  # centralityTimes are the seconds each centrality took when it was
+  # computed, centralityTime the seconds spent here including cache
+  # lookups.
   models['network'] = {'g':g, 
                        'topNodes': topNodes,
-                       'countTrainDocs': len(trainIDs),
+                       'countTrainDocs': countTrainDocs,
                        'countTagTotal' : countTagTotal,
-                       'countEdgeTotal': countEdgeTotal }
-
+                       'countEdgeTotal': countEdgeTotal,
+                       'centralityTimes': times,
+                       'centralityTime' : centralityTime,
+                       'tables': ngnbCompileNetwork(g) }
   return models
 
 
+def ngnbTrain(dictMessages, f, trainIDs, tagList):
+  # Create graph from tags and train binary relevance 
+  # multinomial model
+  g = ngnbCreateNetwork(dictMessages, trainIDs, tagList)
+  models = nbMultiTrain(dictMessages, f, trainIDs, tagList)
+  return ngnbAddNetwork(models, g, len(trainIDs))
+
+
+def ngnbCount(dictMessages, features, docIDs, tagList, base=None):
+  # Additive training counts: the multinomial counts of every
+  # feature plus the tag and tag pair counts of the network.
+  counts = nbMultiCount(dictMessages, features, docIDs, tagList, base)
+  counts['network'] = ngnbCountNetwork(dictMessages, docIDs, tagList)
+  return counts
+
+
+def ngnbSubtract(full, part, features):
+  counts = nbMultiSubtract(full, part, features)
+  counts['network'] = tuple(fc - pc for fc,pc in zip(full['network'], 
+                                                     part['network']))
+  return counts
+
+
+def ngnbTrainFromCounts(counts, features, tagList):
+  nodeCounts, edgeCounts = counts['network']
+  g = ngnbBuildNetwork(nodeCounts, edgeCounts, tagList)
+  models = nbMultiTrainFromCounts(counts, features, tagList)
+  return ngnbAddNetwork(models, g, counts[features[0]]['numDocs'])
+
+
 def ngnbPredict(models, f, dictText, tagList): 
+  tagLogOdds = nbMultiPredictLogOdds(models, f, dictText, tagList)
+  return ngnbPredictFromLogOdds(models, tagLogOdds)
+
+
+def ngnbPredictLazy(models, f, dictText, tagList):
+  # For better scalability, use the top centrality nodes to start a
+  # search for the best initial tag instead of scoring every tag.
+  # The best top node becomes the start tag and the search moves to
+  # a better scoring neighbor until none is found. Log odds are only
+  # computed for the tags visited, each one at most once, so the
+  # network search below finds those of the start tag's neighbors
+  # already computed.
+  tables = ngnbTables(models)
+  model  = models[f]
+  doc    = nbMultiDocTerms(model, dictText)
+  tagSet = set(tagList)
+  edgeCount = tables['edgeCount']
+
+  logOdds = np.empty(len(tables['tags']))
+  logOdds.fill(-np.inf)
+  scored  = np.zeros(len(tables['tags']), dtype=bool)
+
+  remainingTags = np.array([tables['tagIndex'][t] 
+                            for t in models['network']['topNodes'] 
+                            if t in tagSet], dtype=np.int64)
+  startTag = None
+  lpStart  = -1 * sys.float_info.max
+  while(len(remainingTags) > 0):
+    logOdds[remainingTags] = nbMultiTagLogOdds(model, doc, 
+                                               [model['tagIndex'][tables['tags'][i]]
+                                                for i in remainingTags.tolist()])
+    scored[remainingTags] = True
+
+    # Every tag scored so far is at most lpStart, so only the
+    # neighbors not scored yet can improve on the start tag
+    bestTag = remainingTags[logOdds[remainingTags].argmax()]
+    if (logOdds[bestTag] > lpStart):
+      startTag = int(bestTag)
+      lpStart  = logOdds[bestTag]
+      remainingTags = edgeCount.indices[edgeCount.indptr[startTag]:
+                                        edgeCount.indptr[startTag+1]]
+      remainingTags = remainingTags[~scored[remainingTags]]
+    else: 
+      remainingTags = remainingTags[:0]
+
+  if (startTag is None):
+    return []
+  return [tables['tags'][i] for i in ngnbSearch(tables, logOdds, startTag)]
+
+
+def ngnbPredictLazyBatch(models, f, dictMessages, docIDs, tagList):
+  return [ngnbPredictLazy(models, f, dictMessages[sid][f], tagList)
+          for sid in docIDs]
+
+
+def ngnbPredictBatch(models, f, dictMessages, docIDs, tagList):
+  # Score every document against every tag in one batch and then
+  # run the per-document network search on the results.
+  tables  = ngnbTables(models)
+  tagPos  = {t:i for i,t in enumerate(tagList)}
+  cols    = [tagPos[t] for t in tables['tags']]
+  logOdds = nbMultiPredictLogOddsBatch(models, f, dictMessages, 
+                                       docIDs, tagList)[:, cols]
+  return [[tables['tags'][i] for i in ngnbSearch(tables, lo)] 
+          for lo in logOdds]
+
+
+def ngnbCompileNetwork(g):
+  # Pack the tag network into integer indexed arrays so prediction
+  # needs no networkx calls: node counts, self loop counts and a 
+  # sparse matrix of the counts of all other edges, whose rows double
+  # as sorted adjacency lists.
+  tags     = g.nodes()
+  tagIndex = {t:i for i,t in enumerate(tags)}
+
+  selfCount = np.zeros(len(tags))
+  rows = []
+  cols = []
+  data = []
+  for n1, n2, attrs in g.edges_iter(data=True):
+    i, j = tagIndex[n1], tagIndex[n2]
+    if (i == j):
+      selfCount[i] = attrs['count']
+    else:
+      rows.extend([i, j])
+      cols.extend([j, i])
+      data.extend([attrs['count'], attrs['count']])
 
-  # TUNABLES
-  SEARCH_LIMIT   = 5
-  DAMPING_FACTOR = 0.7
+  tables = {}
+  tables['tags']      = tags
+  tables['tagIndex']  = tagIndex
+  tables['nodeCount'] = np.array([g.node[t]['count'] for t in tags], dtype=float)
+  tables['selfCount'] = selfCount
+  tables['edgeCount'] = sp.csr_matrix((np.array(data, dtype=float), (rows, cols)),
+                                      shape=(len(tags), len(tags)))
+  return tables
 
-  model   = models[f]
-  network = models['network']
-  g       = models['network']['g']
-  topTags = models['network']['topNodes']
 
-  # NB
+def ngnbTables(models):
+  network = models['network']
+  tables  = network.get('tables')
+  if (tables is None):
+    tables = network['tables'] = ngnbCompileNetwork(network['g'])
+  return tables
+
+
+def ngnbEdgeBlock(tables, idx):
+  # Dense matrix of the edge counts among the tags idx, 0 where two
+  # tags are not connected.
+  edgeCount = tables['edgeCount']
+  block = np.zeros((len(idx), len(idx)))
+  for a, i in enumerate(idx):
+    start, end = edgeCount.indptr[i], edgeCount.indptr[i+1]
+    if (start == end):
+      continue
+    pos = np.searchsorted(edgeCount.indices[start:end], idx)
+    pos = np.minimum(pos, end - start - 1)
+    hit = edgeCount.indices[start + pos] == idx
+    block[a, hit] = edgeCount.data[start + pos[hit]]
+  return block
+
+
+def ngnbPredictFromLogOdds(models, tagLogOdds):
+  tables = ngnbTables(models)
+  tags   = tables['tags']
+  lo     = np.array([tagLogOdds[t] for t in tags])
+  return [tags[i] for i in ngnbSearch(tables, lo)]
+
+
+def ngnbSubsetScores(block, lpIdx):
+  # Smallest edge count and sum of log odds of every candidate set,
+  # indexed by a bitmask over the candidates 1..K of the edge block,
+  # with the start tag 0 always included. Sets are built up one
+  # candidate at a time, each new set extending a smaller one:
   #
-  # For better scalability, can use the top centrality nodes
-  # to start a search for the best initial tag.
+  #   smallest[mask | bit] = min(smallest[mask], toMask[mask])
+  #   sumLp[mask | bit]    = sumLp[mask] + lpIdx[bit]
   #
-  # remainingTags = set(topTags)
-  # startTag    = None
-  # lpStart     = -1 * sys.float_info.max
-  # while(len(remainingTags) > 0):
-  #   tagLogOdds = nbMultiPredictLogOdds(models, f, dictText, remainingTags)
-  #   bestTag = max(tagLogOdds.iteritems(), key=(lambda v: v[1]))
-  #   if (bestTag[1] > lpStart):
-  #     startTag = bestTag[0]
-  #     lpStart  = bestTag[1]
-  #     remainingTags = set([n for n in nx.all_neighbors(g,startTag)])
-  #   else: 
-  #     remainingTags = set()
-  #  
-  tagLogOdds = nbMultiPredictLogOdds(models, f, dictText, tagList)
-  bestTag = max(tagLogOdds.iteritems(), key=(lambda v: v[1]))
-  startTag = bestTag[0]
-  lpStart  = bestTag[1]
+  # where toMask holds the smallest edge count from the new candidate
+  # to the start tag and the candidates in mask. The work is O(2^K)
+  # array operations instead of O(K^2 2^K) for separate sets.
+  smallest = np.array([np.inf])
+  sumLp    = np.array([lpIdx[0]])
+  for b in range(1, len(lpIdx)):
+    toMask = np.array([block[b][0]])
+    for c in range(1, b):
+      toMask = np.concatenate([toMask, np.minimum(toMask, block[b][c])])
+    smallest = np.concatenate([smallest, np.minimum(smallest, toMask)])
+    sumLp    = np.concatenate([sumLp, sumLp + lpIdx[b]])
+  return smallest, sumLp
+
+
+def ngnbSearchCandidates(tables, logOdds, startTag, searchLimit):
+  # Everything the network search needs for one document that does
+  # not depend on the damping factor. The candidate sets are indexed
+  # by bitmask over the best searchLimit neighbors, so the sets of a
+  # smaller limit are a prefix of them.
+  nodeCount = tables['nodeCount']
+  edgeCount = tables['edgeCount']
+
+  if (startTag is None):
+    startTag = int(logOdds.argmax())
+  lpStart  = logOdds[startTag]
 
   # Examine neighbors around starting tag to find best
   # candidate set. Set the starting log odd to the weighted
   # ratio based on the number of selfloops. This approximates
   # the likelihood that the starting tag is by itself.
-  currentTags   = set([startTag])
-  if (g.has_edge(startTag,startTag)):
-    lpCurrent = lpStart * (float(g.edge[startTag][startTag]['count']) /
-                           g.node[startTag]['count'])
+  candidates = {'startTag': startTag, 'goodTags': []}
+  if (tables['selfCount'][startTag] > 0):
+    candidates['lpCurrent'] = lpStart * (tables['selfCount'][startTag] / 
+                                         nodeCount[startTag])
   else:
-    lpCurrent =  -1 * sys.float_info.max
+    candidates['lpCurrent'] =  -1 * sys.float_info.max
 
-  neighborTags  = set([n for n in nx.all_neighbors(g,startTag)])
-  neighborTags -= currentTags
-  goodTags      = [(t,tagLogOdds[t]) for t in neighborTags if tagLogOdds[t] >=0]
+  neighborTags = edgeCount.indices[edgeCount.indptr[startTag]:
+                                   edgeCount.indptr[startTag+1]]
+  goodTags     = neighborTags[logOdds[neighborTags] >= 0]
 
   if (len(goodTags) > 0):
 
-    goodTags.sort(key=(lambda v: v[1]), reverse=True)
-    goodTags = goodTags[0:min( SEARCH_LIMIT, len(goodTags))]
-    goodTags = set([v[0] for v in goodTags])
-    tagsPowerset = powerset(list(goodTags))
-
-    lpNew = {}
-    for tagsCombo in tagsPowerset:
-      # get the sub-graph and remove all self-loops
-      tryTags = currentTags | set(tagsCombo)
-      sg = nx.subgraph(g,list(tryTags))
-      sg.remove_edges_from(sg.selfloop_edges())
-
-      # NB
-      #
-      # Determine the smallest edgecount in the graph. This 
-      # is basically the negative feedback that avoids the
-      # subgraph expanding indefinitely. The rational is
-      # that the tags are a set and therefore their joint
-      # occurrence is, at most, the smallest edge weight.
-      #
-      # Scale the damping coefficient by a tunable paramter.
-      #
-      smallestCount = min([sg.edge[e[0]][e[1]]['count'] for e in sg.edges_iter()])
-      dampingCoef   = DAMPING_FACTOR * (float(smallestCount)/
-                                        g.node[startTag]['count'])
-
-      # Starting with the tags farthest from the startTag, accumulate
-      # weighted log odds forward
-      tagDist = [(t,nx.shortest_path_length(sg,t,startTag)) for t in tryTags]
-      tagDist.sort(key=(lambda v: v[1]), reverse=True)
-      tagDistDict = {t:d for t,d in tagDist}
-      accruals = Counter()
-      for sgTag,d in tagDist:
-
-        # Weight the per-tag log odd by the damping coefficient
-        lpThisTag   = tagLogOdds[sgTag] * dampingCoef
-        #if (g.has_edge(sgTag,sgTag)):
-        #    # only take log odds for non-single occurrences
-        #    lpThisTag *= (float(g.node[sgTag]['count'] - 
-        #                        g.edge[sgTag][sgTag]['count']) /
-        #                  g.node[sgTag]['count'])
-        accruals[sgTag] += lpThisTag
-
-        if (d > 0):
-          # Propogate accrued log odds to next closest
-          # tags
-          nextTags = [nt for nt in nx.all_neighbors(sg,sgTag) if tagDistDict[nt] < d]
-          for nt in nextTags:
-            accruals[nt] += accruals[sgTag] /len(nextTags)
-
-        else:
-          # This had better be the start node
-          if (not (sgTag == startTag)):
-            pdb.set_trace()
-
-      lpNew[tuple(tagsCombo)] = accruals[startTag]
-
-    # Anything beat the single tag case? 
-    bestTag = max(lpNew.iteritems(), key=(lambda v: v[1]))
-    if (bestTag[1] > lpCurrent):
-      currentTags    = currentTags | set(bestTag[0])
-      lpCurrent      = bestTag[1]
-
-  return list(currentTags)
-
-
-   
-
+    order    = np.argsort(-logOdds[goodTags], kind='mergesort')
+    goodTags = goodTags[order[0:min(searchLimit, len(goodTags))]]
+
+    # Row/column 0 of the block is the start tag, the rest follow
+    # goodTags. Self loops are never on the block's diagonal.
+    idx   = np.concatenate([[startTag], goodTags])
+    block = ngnbEdgeBlock(tables, idx)
+    block[block == 0] = np.inf
+
+    # NB
+    #
+    # Every candidate is a neighbor of the start tag, so in the
+    # candidate's sub-graph each added tag is one hop from the start
+    # and the accrued log odds reduce to the damped sum of the log 
+    # odds of the start tag and the added tags.
+    #
+    # The smallest edgecount in the sub-graph is the negative feedback 
+    # that avoids the subgraph expanding indefinitely. The rational
+    # is that the tags are a set and therefore their joint
+    # occurrence is, at most, the smallest edge weight.
+    #
+    smallestCount, sumLp = ngnbSubsetScores(block, logOdds[idx])
+    candidates['goodTags']   = [int(t) for t in goodTags]
+    candidates['countRatio'] = smallestCount[1:] / nodeCount[startTag]
+    candidates['sumLp']      = sumLp[1:]
+
+  return candidates
+
+
+def ngnbSearchChoose(candidates, searchLimit, dampingFactor):
+  # Best tag set among the candidates of the first searchLimit 
+  # neighbors. Returns tag IDs.
+  currentTags = [candidates['startTag']]
+  goodTags    = candidates['goodTags'][0:searchLimit]
+  if (len(goodTags) > 0):
 
+    # Scale the damping coefficient by a tunable paramter.
+    numSets     = 2**len(goodTags) - 1
+    dampingCoef = dampingFactor * candidates['countRatio'][0:numSets]
+    lpNew       = dampingCoef * candidates['sumLp'][0:numSets]
 
-  
+    # Anything beat the single tag case? 
+    bestMask = lpNew.argmax() + 1
+    if (lpNew[bestMask - 1] > candidates['lpCurrent']):
+      currentTags += [t for i,t in enumerate(goodTags) if ((bestMask >> i) & 1)]
+
+  return currentTags
+
+
+def ngnbSearch(tables, logOdds, startTag=None):
+  # Network search on the compiled tables for one document, given
+  # the log odds of the tags in table order. Starts from the best
+  # tag unless startTag is given, in which case only the log odds of
+  # the start tag and its neighbors are used. Returns tag IDs.
+  candidates = ngnbSearchCandidates(tables, logOdds, startTag, SEARCH_LIMIT)
+  return ngnbSearchChoose(candidates, SEARCH_LIMIT, DAMPING_FACTOR)
+
+
+def ngnbSweepBatch(models, f, dictMessages, docIDs, tagList, grid):
+  # Predictions of ngnbPredictBatch for every (search limit, damping
+  # factor) pair in grid. The log odds and the candidate sets of each
+  # document are computed once, for the largest limit, and shared by
+  # all pairs. Returns a dict from each pair to the per document tags.
+  tables  = ngnbTables(models)
+  tagPos  = {t:i for i,t in enumerate(tagList)}
+  cols    = [tagPos[t] for t in tables['tags']]
+  logOdds = nbMultiPredictLogOddsBatch(models, f, dictMessages, 
+                                       docIDs, tagList)[:, cols]
+  maxLimit   = max([searchLimit for searchLimit, dampingFactor in grid])
+  candidates = [ngnbSearchCandidates(tables, lo, None, maxLimit) 
+                for lo in logOdds]
+
+  predictions = {}
+  for searchLimit, dampingFactor in grid:
+    predictions[(searchLimit, dampingFactor)] = [
+      [tables['tags'][i] for i in ngnbSearchChoose(c, searchLimit, dampingFactor)]
+      for c in candidates]
+  return predictions
+
+
+def ngnbSaveNetwork(network, dirName):
+  # The compiled tables hold all of the network's counts, so the
+  # graph itself is rebuilt from them on load
+  tables = ngnbTables({'network': network})
+  writeLines(os.path.join(dirName, 'tags.txt'),     tables['tags'])
+  writeLines(os.path.join(dirName, 'topNodes.txt'), sorted(network['topNodes']))
+  saveArray(dirName, 'nodeCount', tables['nodeCount'])
+  saveArray(dirName, 'selfCount', tables['selfCount'])
+  saveCSR(dirName, 'edgeCount',   tables['edgeCount'])
+
+  values = {'countTrainDocs': network['countTrainDocs'],
+            'centralityTime': network['centralityTime']}
+  for name, t in network['centralityTimes'].iteritems():
+    values['centralityTimes.' + name] = t
+  saveValues(dirName, values)
+
+
+def ngnbLoadNetwork(dirName):
+  values = loadValues(dirName)
+
+  tables = {}
+  tables['tags']      = readLines(os.path.join(dirName, 'tags.txt'))
+  tables['tagIndex']  = {t:i for i,t in enumerate(tables['tags'])}
+  tables['nodeCount'] = loadArray(dirName, 'nodeCount')
+  tables['selfCount'] = loadArray(dirName, 'selfCount')
+  tables['edgeCount'] = loadCSR(dirName, 'edgeCount')
+
+  edgeCounts = (sp.triu(tables['edgeCount'], k=1) + 
+                sp.diags(tables['selfCount'], 0)).tocsr()
+  g = ngnbBuildNetwork(tables['nodeCount'], edgeCounts, tables['tags'])
+
+  network = {}
+  network['g']               = g
+  network['topNodes']        = set(readLines(os.path.join(dirName, 'topNodes.txt')))
+  network['countTrainDocs']  = int(values['countTrainDocs'])
+  network['countTagTotal']   = int(tables['nodeCount'].sum())
+  network['countEdgeTotal']  = int(edgeCounts.sum())
+  network['centralityTimes'] = {k.split('.', 1)[1]: v for k,v in values.iteritems()
+                                if k.startswith('centralityTimes.')}
+  network['centralityTime']  = values['centralityTime']
+  network['tables']          = tables
+  return network
+
+
+def ngnbSave(models, features, tagList, dirName):
+  modelDirSave(dirName, 'ngnb', features, tagList)
+  for f in features:
+    nbMultiSaveSingle(models[f], modelPartDir(dirName, f))
+  ngnbSaveNetwork(models['network'], modelPartDir(dirName, 'network'))
+
+
+def ngnbLoad(dirName, features):
+  models = nbMultiLoad(dirName, features)
+  models['network'] = ngnbLoadNetwork(os.path.join(dirName, 'network'))
+  return models
@@ -14,99 +14,229 @@
 
 import os, os.path
 import sys
+import multiprocessing
 
 from collections import Counter
 from math        import log
+from multiprocessing.sharedctypes import RawArray
+
+import numpy        as np
+import scipy.sparse as sp
+
+from docTerm      import docTermMatrix, docTermMatrixVocab, docTagMatrix
+from docTerm      import indptrNonzeros, rowNonzeros
+from messageStore import writeLines, readLines
+from modelStore   import modelDirSave, modelPartDir, saveArray, loadArray
+from modelStore   import saveValues, loadValues
+
+# Documents scored at a time by pmm1PredictBatch. Each greedy round
+# holds a (non-zeros x tags) array for the block, so this bounds the
+# memory used for large test sets.
+PREDICT_BLOCK_SIZE = 1000
+
+
+def pmm1EMData(dictMessages, f, trainIDs, tagList):
+  # Arrays for running EM over the training documents. Each pair is
+  # a non-zero of the doc-term matrix X together with one of the
+  # tags of its document, and each entry a (tag, word) combination
+  # found in some pair. Entries are the parameters of the model and
+  # are sorted by tag ID, then word ID.
+  X, words = docTermMatrixVocab(dictMessages, f, trainIDs)
+  Y        = docTagMatrix(dictMessages, trainIDs, tagList)
+  V        = len(words)
+
+  docs         = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+  pos, lengths = indptrNonzeros(Y.indptr, docs)
+  pairNz       = np.repeat(np.arange(X.nnz), lengths)
+  pairTag      = Y.indices[pos].astype(np.int64)
+  entryKeys, pairEntry = np.unique(pairTag * V + X.indices[pairNz],
+                                   return_inverse=True)
+
+  data = {}
+  data['words']     = words
+  data['tags']      = tagList
+  data['V']         = V
+  data['nnz']       = X.nnz
+  data['pairNz']    = pairNz
+  data['pairEntry'] = pairEntry
+  data['pairCount'] = X.data[pairNz]
+  data['pairMult']  = Y.data[pos]
+  data['entryTag']  = entryKeys // V
+  data['entryWord'] = entryKeys % V
+  return data
+
+
+def pmm1EMInitial(data):
+  # Per-label word frequencies
+  numEntries = len(data['entryTag'])
+  counts = np.bincount(data['pairEntry'], data['pairCount'] * data['pairMult'],
+                       minlength=numEntries)
+  countVocabTag = np.bincount(data['entryTag'], counts, 
+                              minlength=len(data['tags']))
+  return counts / countVocabTag[data['entryTag']]
+
+
+def pmm1EStep(data, pEntry):
+  # Calculate the G parameters, each pair's share of its word over
+  # the document's tags, and sum the M-step numerators
+  # x * g + 1 of every entry.
+  pPair   = pEntry[data['pairEntry']]
+  sumProb = np.bincount(data['pairNz'], pPair * data['pairMult'], 
+                        minlength=data['nnz'])
+  g       = pPair / sumProb[data['pairNz']]
+  return np.bincount(data['pairEntry'], data['pairCount'] * g + 1,
+                     minlength=len(pEntry))
+
+
+def pmm1MStep(data, sums):
+  # Calculate updated per-label word probabilities
+  sumProbs = np.bincount(data['entryTag'], sums, 
+                         minlength=len(data['tags'])) + data['V']
+  return sums / sumProbs[data['entryTag']]
+
+
+def pmm1EMModel(data, pEntry):
+  # Build model structure with final probabilities
+  words    = data['words']
+  tagList  = data['tags']
+  bounds   = np.searchsorted(data['entryTag'], np.arange(len(tagList) + 1))
+  pWordTag = {}
+  for i,t in enumerate(tagList):
+    b, e = bounds[i], bounds[i+1]
+    pWordTag[t] = dict(zip([words[w] for w in data['entryWord'][b:e].tolist()],
+                           pEntry[b:e].tolist()))
 
+  model = {}
+  model['pWordTag']     = pWordTag
+  model['pWordSmooth']  = float(1)/data['V']
+  model['pTagPrior']    = float(1)/len(pWordTag)
+  return model
 
-def pmm1TrainSingle(dictMessages, f, trainIDs, tagList):
-
-  # Compute aggregate per-label word frequencies to get initial
-  # probabilities
-  dictVocabAll  = Counter()
-  dictVocabTag  = Counter()
-  countVocabTag = Counter()  
-  
-  for t in tagList:
-    dictVocabTag[t]  = Counter()
-
-  for sid in trainIDs:
-    tags  = [t for t in dictMessages[sid]['tags'] if t in tagList]
-    text = dictMessages[sid][f]
-
-    for w,c in text.iteritems():
-      dictVocabAll[w] += c
-
-    if (len(tags) == 0):
-      continue
-
-    for t in tags:
-      for w,c in text.iteritems():
-        dictVocabTag[t][w] += c
-        countVocabTag[t]   += c
-
-  pWordTag = {}
-  for t in tagList:
-    pWordTag[t] = {w:(float(c)/countVocabTag[t]) for 
-                   w,c in dictVocabTag[t].iteritems()}
 
+def pmm1EMRun(data, pEntry, eStep):
   # Iterate until convergence
-  V = len(dictVocabAll)
-  delta     = float("inf")
+  delta         = float("inf")
   lastMaxChange = 0
   iterations    = 0
   while (delta > .01):
     iterations += 1
- 
-    # Calculate G parameters
-    g_nli = {t:{w:{} for w in pWordTag[t].keys()} for t in tagList}
-    for sid in trainIDs:
-      tags  = [t for t in dictMessages[sid]['tags'] if t in tagList]
-      text = dictMessages[sid][f]
-
-      for w in text.iterkeys():      
-        sumProb = sum([pWordTag[t][w] for t in tags])
-        for t in tags:
-          g_nli[t][w][sid] = pWordTag[t][w] / sumProb
-
-    # Calculate updated per-label word probabilities
+
+    pEntryNew = pmm1MStep(data, eStep(pEntry))
     maxChange = 0
-    pWordTagNew = {t:{} for t in tagList}
-    for t in tagList:
-      sumProbs = 0
-      for w in pWordTag[t].iterkeys(): 
-        pWordTagNew[t][w] = 0
-        for sid in g_nli[t][w].iterkeys():
-          tmp = dictMessages[sid][f][w] * g_nli[t][w][sid] + 1 
-          pWordTagNew[t][w] += tmp
-          sumProbs += tmp 
-
-      sumProbs += V
-      for w in pWordTag[t].iterkeys(): 
-        pWordTagNew[t][w] /= sumProbs
-        maxChange = max(maxChange, abs(pWordTagNew[t][w] - 
-                                       pWordTag[t][w])/pWordTag[t][w])
-
-    pWordTag = pWordTagNew
+    if (len(pEntry) > 0):
+      maxChange = np.max(np.abs(pEntryNew - pEntry) / pEntry)
+    pEntry = pEntryNew
 
     delta  = abs(maxChange - lastMaxChange)
     lastMaxChange = maxChange
 
-
-  # Build model structure with final probabilities
-  model = {}
-  model['pWordTag']     = pWordTag
-  model['pWordSmooth']  = float(1)/V
-  model['pTagPrior']    = float(1)/len(pWordTag)
-  
+  return pEntry, iterations
+
+
+# Data shared with the E-step worker processes. It is set before the
+# pool is created so forked workers inherit their shards of the pair
+# arrays. The parameters and the per-shard sums are exchanged through
+# shared memory on every iteration.
+emState = {}
+
+
+def pmm1EStepShard(shard):
+  numEntries = len(emState['pEntry'])
+  pEntry = np.frombuffer(emState['pEntry'])
+  sums   = np.frombuffer(emState['sums']).reshape(-1, numEntries)
+  sums[shard] = pmm1EStep(emState['shards'][shard], pEntry)
+
+
+def pmm1EMRunParallel(data, pEntry, jobs):
+  # Split the pairs into one contiguous shard per worker, cutting only
+  # between non-zeros so every word's tags stay in the same shard.
+  pairNz   = data['pairNz']
+  numPairs = len(pairNz)
+  cuts     = [(i * numPairs) / jobs for i in range(jobs)]
+  bounds   = np.searchsorted(pairNz, pairNz[cuts]).tolist() + [numPairs]
+
+  shards = []
+  for b,e in zip(bounds[:-1], bounds[1:]):
+    shard = {}
+    shard['pairNz']    = pairNz[b:e] - pairNz[b]
+    shard['pairEntry'] = data['pairEntry'][b:e]
+    shard['pairCount'] = data['pairCount'][b:e]
+    shard['pairMult']  = data['pairMult'][b:e]
+    shard['nnz']       = pairNz[e-1] - pairNz[b] + 1 if (e > b) else 0
+    shards.append(shard)
+
+  emState['shards'] = shards
+  emState['pEntry'] = RawArray('d', len(pEntry))
+  emState['sums']   = RawArray('d', len(shards) * len(pEntry))
+  sharedP    = np.frombuffer(emState['pEntry'])
+  sharedSums = np.frombuffer(emState['sums']).reshape(len(shards), -1)
+
+  def eStep(pEntry):
+    sharedP[:] = pEntry
+    pool.map(pmm1EStepShard, range(len(shards)))
+    return sharedSums.sum(axis=0)
+
+  pool = multiprocessing.Pool(jobs)
+  try:
+    pEntry, iterations = pmm1EMRun(data, pEntry, eStep)
+  finally:
+    pool.close()
+    pool.join()
+    emState.clear()
+  return pEntry, iterations
+
+
+def pmm1EMWarm(data, pEntry, pWordTagInit):
+  # Start from the probabilities of an earlier solution, e.g. of the
+  # same or an overlapping training set. Entries it does not have
+  # start at the smoothing probability and each tag's entries are
+  # rescaled to the tag's total probability in that solution, so
+  # they are on the scale of the M-step. Tags it does not have keep
+  # their frequency estimates.
+  words    = data['words']
+  tagList  = data['tags']
+  smooth   = float(1)/data['V']
+  bounds   = np.searchsorted(data['entryTag'], np.arange(len(tagList) + 1))
+  pEntry   = pEntry.copy()
+  for i,t in enumerate(tagList):
+    b, e   = bounds[i], bounds[i+1]
+    pWords = pWordTagInit.get(t)
+    if ((not pWords) or (b == e)):
+      continue
+    pInit = np.array([pWords.get(words[w], smooth) for w in 
+                      data['entryWord'][b:e].tolist()], dtype=float)
+    pEntry[b:e] = pInit * (sum(pWords.itervalues()) / pInit.sum())
+  return pEntry
+
+
+def pmm1TrainSingle(dictMessages, f, trainIDs, tagList, jobs=1, 
+                    pWordTagInit=None):
+  data   = pmm1EMData(dictMessages, f, trainIDs, tagList)
+  pEntry = pmm1EMInitial(data)
+  if (pWordTagInit is not None):
+    pEntry = pmm1EMWarm(data, pEntry, pWordTagInit)
+
+  # With more than one job the E-step of every iteration is spread
+  # over a pool of processes.
+  if ((jobs > 1) and (len(data['pairNz']) > 0)):
+    pEntry, iterations = pmm1EMRunParallel(data, pEntry, jobs)
+  else:
+    pEntry, iterations = pmm1EMRun(data, pEntry, 
+                                   lambda p: pmm1EStep(data, p))
+
+  model = pmm1EMModel(data, pEntry)
+  model['iterations'] = iterations
   return model
 
 
-def pmm1Train(dictMessages, features, trainIDs, tagList):
+def pmm1Train(dictMessages, features, trainIDs, tagList, init=None, jobs=1):
+  # init optionally holds earlier models, e.g. from the previous 
+  # fold, whose pWordTag is used to warm start EM for each feature.
   pmm1Models = {}
   for f in features:
     pmm1Models[f] = pmm1TrainSingle(dictMessages, f, 
-                                    trainIDs, tagList)
+                                    trainIDs, tagList, jobs,
+                                    None if init is None else init[f]['pWordTag'])
 
   return pmm1Models
 
@@ -130,28 +260,215 @@ def pmm1PredictTags(model, tags, dictText, includePriors=True):
 
 
 def pmm1Predict(models, f, dictText, tagList):
-  model         = models[f]
-  currentTags   = set()
-  remainingTags = set(tagList)
-  lpCurrent     = -1 * sys.float_info.max
-  converged     = False
-  while ((not converged) and (len(remainingTags) > 0)):
-    lpNew = {}
-    for t in remainingTags:
-      tryTags = currentTags | set([t])
-      lpTags = pmm1PredictTags(model, list(tryTags), dictText)
-      lpNew[tuple(tryTags)] = lpTags
-
-    bestTag = max(lpNew.iteritems(), key=(lambda v: v[1]))
-    if (bestTag[1] > lpCurrent):
-      currentTags     = set(list(bestTag[0]))
-      remainingTags  -= currentTags
-      lpCurrent       = bestTag[1]
+  # Greedily add the tag that most improves the document's log
+  # probability. The per-word mixture sums of the current tag set
+  # are kept so every candidate addition is scored at once from a
+  # |doc| x T slice of the word probabilities.
+  model     = models[f]
+  scorer    = pmm1Scorer(model)
+  wordIndex = scorer['wordIndex']
+  oov       = scorer['oov']
+  tagList   = list(tagList)
+  cols      = np.array([scorer['tagIndex'][t] for t in tagList], dtype=np.intp)
+  rows      = np.array([wordIndex.get(w, oov) for w in dictText.iterkeys()],
+                       dtype=np.intp)
+  counts    = np.array(dictText.values(), dtype=float)
+  pWord     = scorer['pWord'][rows[:, np.newaxis], cols]
+
+  lpPrior   = log(model['pTagPrior'])
+  docLength = counts.sum()
+  running   = np.zeros(len(rows))
+  chosen    = np.zeros(len(tagList), dtype=bool)
+  lpCurrent = -1 * sys.float_info.max
+  numTags   = 0
+  while (numTags < len(tagList)):
+    tryCount = numTags + 1
+    lpNew    = counts.dot(np.log(running[:, np.newaxis] + pWord))
+    lpNew   += tryCount * lpPrior - docLength * log(tryCount)
+    lpNew[chosen] = -np.inf
+
+    bestTag = lpNew.argmax()
+    if (lpNew[bestTag] > lpCurrent):
+      chosen[bestTag] = True
+      running        += pWord[:, bestTag]
+      lpCurrent       = lpNew[bestTag]
+      numTags        += 1
     else:
-      converged = True
+      break
+
+  return [tagList[i] for i in np.flatnonzero(chosen)]
+
+
+def pmm1Compile(model):
+  # Pack the per-tag word probabilities into a dense matrix indexed
+  # by word ID and tag ID. Missing entries and the last row, used for
+  # words outside the vocabulary, hold the smoothing probability.
+  tags      = model['pWordTag'].keys()
+  tagIndex  = {t:i for i,t in enumerate(tags)}
+  words     = set()
+  for t in tags:
+    words.update(model['pWordTag'][t].iterkeys())
+  wordIndex = {w:i for i,w in enumerate(words)}
+  oov       = len(wordIndex)
+
+  pWord = np.empty((oov + 1, len(tags)))
+  pWord.fill(model['pWordSmooth'])
+  for i,t in enumerate(tags):
+    pWords = model['pWordTag'][t]
+    rows   = [wordIndex[w] for w in pWords.iterkeys()]
+    pWord[rows, i] = pWords.values()
+
+  scorer = {}
+  scorer['wordIndex'] = wordIndex
+  scorer['tagIndex']  = tagIndex
+  scorer['oov']       = oov
+  scorer['pWord']     = pWord
+  return scorer
+
+
+def pmm1Scorer(model):
+  scorer = model.get('scorer')
+  if (scorer is None):
+    scorer = model['scorer'] = pmm1Compile(model)
+  return scorer
+
+
+def pmm1PredictBatch(models, f, dictMessages, docIDs, tagList):
+  # Greedy tag selection run for blocks of documents at once
+  model   = models[f]
+  scorer  = pmm1Scorer(model)
+  tagList = list(tagList)
+  cols    = np.array([scorer['tagIndex'][t] for t in tagList], dtype=np.intp)
+  pWord   = scorer['pWord'][:, cols]
+  X       = docTermMatrix(dictMessages, f, docIDs, 
+                          scorer['wordIndex'], scorer['oov'])
+
+  predictions = []
+  for b in range(0, X.shape[0], PREDICT_BLOCK_SIZE):
+    chosen = pmm1PredictRows(model, pWord, X[b:(b + PREDICT_BLOCK_SIZE)])
+    predictions.extend([[tagList[i] for i in np.flatnonzero(c)] for c in chosen])
+  return predictions
+
+
+def pmm1PredictRows(model, pWord, X):
+  # Each round scores every candidate addition for every still-active
+  # document from the running per-word mixture sums of its current 
+  # tag set. Returns the documents x tags matrix of chosen tags.
+  numDocs    = X.shape[0]
+  numTags    = pWord.shape[1]
+  lpPrior    = log(model['pTagPrior'])
+  docLength  = np.asarray(X.sum(axis=1)).ravel()
+  running    = np.zeros(X.nnz)
+  numCurrent = np.zeros(numDocs)
+  lpCurrent  = np.empty(numDocs)
+  lpCurrent.fill(-1 * sys.float_info.max)
+  chosen     = np.zeros((numDocs, numTags), dtype=bool)
+  active     = np.arange(numDocs)
+
+  while ((len(active) > 0) and (numTags > 0)):
+    # Sum the candidate word log probabilities per document with a 
+    # sparse matrix whose rows select each document's non-zeros.
+    nz, lengths = rowNonzeros(X, active)
+    sumNZ = sp.csr_matrix((X.data[nz], np.arange(len(nz)),
+                           np.concatenate([[0], np.cumsum(lengths)])),
+                          shape=(len(active), len(nz)))
+
+    tryCount = numCurrent[active] + 1
+    lpNew    = sumNZ.dot(np.log(running[nz][:, np.newaxis] + 
+                                pWord[X.indices[nz]]))
+    lpNew   -= (docLength[active] * np.log(tryCount))[:, np.newaxis]
+    lpNew   += (tryCount * lpPrior)[:, np.newaxis]
+    lpNew[chosen[active]] = -np.inf
+
+    bestTag  = lpNew.argmax(axis=1)
+    bestLp   = lpNew[np.arange(len(active)), bestTag]
+    improved = bestLp > lpCurrent[active]
+
+    active  = active[improved]
+    bestTag = bestTag[improved]
+    chosen[active, bestTag] = True
+    numCurrent[active] += 1
+    lpCurrent[active]   = bestLp[improved]
+
+    nz, lengths  = rowNonzeros(X, active)
+    running[nz] += pWord[X.indices[nz], np.repeat(bestTag, lengths)]
+
+    active = active[numCurrent[active] < numTags]
+
+  return chosen
+
+
+def pmm1SaveSingle(model, dirName):
+  # Save the word probabilities as (tag ID, word ID, probability)
+  # entries sorted by tag, with the IDs of the compiled scorer so
+  # loading gives back the same scorer
+  scorer = pmm1Scorer(model)
+  words  = sorted(scorer['wordIndex'], key=scorer['wordIndex'].get)
+  tags   = sorted(scorer['tagIndex'], key=scorer['tagIndex'].get)
+
+  entryTag  = []
+  entryWord = []
+  pEntry    = []
+  for i,t in enumerate(tags):
+    pWords = model['pWordTag'][t]
+    entryTag.extend([i] * len(pWords))
+    entryWord.extend([scorer['wordIndex'][w] for w in pWords.iterkeys()])
+    pEntry.extend(pWords.itervalues())
+
+  writeLines(os.path.join(dirName, 'words.txt'), words)
+  writeLines(os.path.join(dirName, 'tags.txt'),  tags)
+  saveArray(dirName, 'entryTag',  np.array(entryTag,  dtype=np.int32))
+  saveArray(dirName, 'entryWord', np.array(entryWord, dtype=np.int32))
+  saveArray(dirName, 'pEntry',    np.array(pEntry,    dtype=float))
+
+  values = {'pWordSmooth': model['pWordSmooth'], 
+            'pTagPrior':   model['pTagPrior']}
+  if ('iterations' in model):
+    values['iterations'] = model['iterations']
+  saveValues(dirName, values)
+
+
+def pmm1LoadSingle(dirName):
+  words     = readLines(os.path.join(dirName, 'words.txt'))
+  tags      = readLines(os.path.join(dirName, 'tags.txt'))
+  entryTag  = loadArray(dirName, 'entryTag')
+  entryWord = loadArray(dirName, 'entryWord')
+  pEntry    = loadArray(dirName, 'pEntry')
+  values    = loadValues(dirName)
+
+  bounds   = np.searchsorted(entryTag, np.arange(len(tags) + 1))
+  pWordTag = {}
+  for i,t in enumerate(tags):
+    b, e = bounds[i], bounds[i+1]
+    pWordTag[t] = dict(zip([words[w] for w in entryWord[b:e].tolist()],
+                           pEntry[b:e].tolist()))
+
+  scorer = {}
+  scorer['wordIndex'] = {w:i for i,w in enumerate(words)}
+  scorer['tagIndex']  = {t:i for i,t in enumerate(tags)}
+  scorer['oov']       = len(words)
+  scorer['pWord']     = np.empty((len(words) + 1, len(tags)))
+  scorer['pWord'].fill(values['pWordSmooth'])
+  scorer['pWord'][entryWord, entryTag] = pEntry
 
-  return list(currentTags)
+  model = {}
+  model['pWordTag']    = pWordTag
+  model['pWordSmooth'] = values['pWordSmooth']
+  model['pTagPrior']   = values['pTagPrior']
+  model['scorer']      = scorer
+  if ('iterations' in values):
+    model['iterations'] = int(values['iterations'])
+  return model
 
 
+def pmm1Save(models, features, tagList, dirName):
+  modelDirSave(dirName, 'pmm1', features, tagList)
+  for f in features:
+    pmm1SaveSingle(models[f], modelPartDir(dirName, f))
 
 
+def pmm1Load(dirName, features):
+  models = {}
+  for f in features:
+    models[f] = pmm1LoadSingle(os.path.join(dirName, f))
+  return models
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# ------------------------------------------------------------
+# predict.py
+#
+# Python script to tag documents with a model saved by
+# runtest.py -save. Writes a CSV file with the predicted
+# tags of each document.
+#
+# ------------------------------------------------------------
+
+import os, os.path
+import sys
+import argparse
+import csv
+import time
+
+from messageStore  import loadDictionaries
+from modelStore    import modelDirLoad
+from nbMultinomial import *
+from pmm1          import *
+from ngnb          import *
+
+import nbMultinomial
+
+
+# Documents predicted at a time
+BATCH_SIZE = 1000
+
+
+# ------------------------------------------------------------
+# MAIN
+
+
+methods = {
+  "nbMulti" : {"load": nbMultiLoad,
+               "predictBatch": nbMultiPredictBatch},
+  "pmm1"    : {"load": pmm1Load,
+               "predictBatch": pmm1PredictBatch},
+  "ngnb"    : {"load": ngnbLoad,
+               "predictBatch": ngnbPredictBatch},
+  "ngnbLazy": {"load": ngnbLoad,
+               "predictBatch": ngnbPredictLazyBatch}
+}
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(
+    description='Tag documents with a saved model.')
+
+  parser.add_argument('modelDir',
+                      help='Saved model directory')
+
+  parser.add_argument('dataFile',
+                      help='Documents to tag, a dictionary file or dataset directory')
+
+  parser.add_argument('outFile',
+                      help='Output CSV file')
+
+  parser.add_argument('-method',
+                      action="store",
+                      dest="method",
+                      default=None,
+                      help='Prediction method, by default that of the saved model')
+
+  parser.add_argument('-lcache',
+                      action="store",
+                      dest="logOddsCache",
+                      default=None,
+                      help='Directory in which to cache multinomial log odds')
+
+  args = parser.parse_args()
+
+  kind, features, tagList = modelDirLoad(args.modelDir)
+  method = args.method or kind
+  if (not method in methods):
+    print("Error, unknow method")
+    sys.exit()
+
+  if (methods[method]['load'] is not methods[kind]['load']):
+    print("Error, {} can't predict with a saved {} model".format(method, kind))
+    sys.exit()
+
+  nbMultinomial.LOGODDS_CACHE = args.logOddsCache
+
+  sys.stderr.write("Loading model.............")
+  loadTime = time.time()
+  models   = methods[method]['load'](args.modelDir, features)
+  loadTime = time.time() - loadTime
+  sys.stderr.write("DONE ({:.3f}s)\n".format(loadTime))
+
+  sys.stderr.write("Loading dictionaries......")
+  dictMessages, dictTagCounts, dictTagIndex = loadDictionaries(args.dataFile)
+  sys.stderr.write("DONE\n")
+
+  # Each feature's predictions are merged as in testing, keeping
+  # the tags in the order they were first predicted
+  sys.stderr.write("Predicting................")
+  docIDs = dictMessages.keys()
+  fdw    = open(args.outFile, 'wb')
+  writer = csv.writer(fdw, delimiter=',', quotechar='"',
+                      quoting=csv.QUOTE_ALL)
+  writer.writerow(['Id', 'Tags'])
+  for b in range(0, len(docIDs), BATCH_SIZE):
+    batchIDs = docIDs[b:(b + BATCH_SIZE)]
+    docTags  = [[] for sid in batchIDs]
+    for f in features:
+      for tags, predictions in zip(docTags,
+                                   methods[method]['predictBatch'](
+                                     models, f, dictMessages, batchIDs, tagList)):
+        tags.extend([t for t in predictions if not t in tags])
+
+    writer.writerows([[sid, ' '.join(tags)] for sid, tags in zip(batchIDs, docTags)])
+  fdw.close()
+  sys.stderr.write("DONE\n")
+
+  sys.stdout.write("Tagged {} documents\n".format(len(docIDs)))
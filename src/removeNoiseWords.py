@@ -17,6 +17,9 @@ import itertools
 from collections import Counter
 import cPickle as pickle
 
+from messageStore import MessageStore, messageStoreFilter
+from messageStore import messageStoreSave, loadDictionaries
+
 def countWords(dictMessages, tagList):
 
   # Create overall dictionary dictionary
@@ -165,6 +168,9 @@ def giniSelectWords(counts, thresh):
 
 
 def filterMessages(dictMessages, dictField):
+  if (isinstance(dictMessages, MessageStore)):
+    return messageStoreFilter(dictMessages, dictField)
+
   filteredDict = {}
   for sid in dictMessages.iterkeys():
     tags  = dictMessages[sid]['tags']
@@ -219,12 +225,7 @@ if __name__ == "__main__":
     sys.exit()
 
   # Open input file
-  fdDicts = open(args.inFile, 'rb')
-  reader = pickle.Unpickler(fdDicts)
-  dictMessages  = reader.load()
-  dictTagCounts = reader.load()
-  dictTagIndex  = reader.load()
-  fdDicts.close()
+  dictMessages, dictTagCounts, dictTagIndex = loadDictionaries(args.inFile)
 
   # Count words per tag and field
   counts = countWords(dictMessages, dictTagCounts.keys())
@@ -235,10 +236,14 @@ if __name__ == "__main__":
   # filter the data set to only include important words
   dictFiltered = filterMessages(dictMessages, dictSelected)
 
-  # Write dictionaries out in pickle file
-  outstream = open(args.outFile, 'wb')
-  writer = pickle.Pickler(outstream, pickle.HIGHEST_PROTOCOL)
-  writer.dump(dictFiltered)
-  writer.dump(dictTagCounts)
-  writer.dump(dictTagIndex)
-  outstream.close()
+  # Dataset directories are written back out in the same format,
+  # everything else goes to a pickle file
+  if (os.path.isdir(args.inFile)):
+    messageStoreSave(dictFiltered, args.outFile)
+  else:
+    outstream = open(args.outFile, 'wb')
+    writer = pickle.Pickler(outstream, pickle.HIGHEST_PROTOCOL)
+    writer.dump(dictFiltered)
+    writer.dump(dictTagCounts)
+    writer.dump(dictTagIndex)
+    outstream.close()
@@ -11,70 +11,136 @@ import os, os.path
 import sys
 import argparse
 import time
+import functools
+import multiprocessing
 
-from cPickle       import Unpickler
+import random
 from random        import shuffle
+from messageStore  import loadDictionaries
+from evaluate      import test, testSweep, resultString
+from modelStore    import modelDirLoad
 from nbMultinomial import *
 from pmm1          import *
 from ngnb          import *
 
+import nbMultinomial
+import ngnb
+
 
 # ------------------------------------------------------------
 # KFOLD
 
 
-def test(fnPredict, models, features, dictMessages, testDocIDs, tagList):
-  results = {'tp': 0, 'fp': 0, 'fn': 0, 
-             'mean-prec': 0, 'mean-rec': 0, 
-             'mean-f1':0}
-  for sid in testDocIDs:
-    tagsActual  = set([t for t in dictMessages[sid]['tags'] if t in tagList])
-
-    predictions = set()
-    for f in features:
-      text = dictMessages[sid][f]
-      predictions |= set(fnPredict(models, f, text, tagList))
-
-    #print(",".join(tagsActual) + " : " + ",".join(predictions))
-    tp = len(tagsActual & predictions)
-    fp = len(predictions - tagsActual)
-    fn = len(tagsActual - predictions) 
-
-    if ((tp + fp) > 0):
-      precision = float(tp) / (tp + fp)
-    else: 
-      precision = 0
-
-    if ((tp+fn) > 0):
-      recall = float(tp) / (tp + fn)   
-    else:
-      recall = 0
+# Data shared with the fold worker processes. It is set before the
+# pool is created so forked workers inherit it copy-on-write instead
+# of receiving a pickled copy of the data set.
+kfoldState = {}
+
+
+def runFold(fold):
+  model        = kfoldState['model']
+  features     = kfoldState['features']
+  dictMessages = kfoldState['dictMessages']
+  docIDs       = kfoldState['docIDs']
+  tagList      = kfoldState['tagList']
+  binIDs       = kfoldState['binIDs']
+  fullCounts   = kfoldState['fullCounts']
+  doTrainTest  = kfoldState['doTrainTest']
+  doTest       = kfoldState['doTest']
+  testJobs     = kfoldState['testJobs']
+  warmStart    = kfoldState['warmStart']
+  initModels   = kfoldState['initModels']
+  grid         = kfoldState['grid']
+  verbose      = kfoldState['verbose']
+
+  def progress(s):
+    if (verbose):
+      sys.stderr.write(s)
+
+  progress("-- Fold {}\n".format(fold+1))
+  testIDs  = binIDs[fold]
+  if (len(binIDs) > 1):
+    trainIDs = list((set(docIDs)).difference(testIDs))
+  else:
+    trainIDs = binIDs[fold]
+
+  progress("  Training................")    
+  trainTime = time.time()
+  if (fullCounts is not None):
+    testCounts = model['count'](dictMessages, features, testIDs, tagList, 
+                                fullCounts)
+    models = model['trainCounts'](model['subtract'](fullCounts, testCounts,
+                                                    features),
+                                  features, tagList)
+  elif (warmStart and ('lastModels' in kfoldState)):
+    models = model['train'](dictMessages, features, trainIDs, tagList,
+                            init=kfoldState['lastModels'])
+  elif (initModels is not None):
+    models = model['train'](dictMessages, features, trainIDs, tagList,
+                            init=initModels)
+  else:
+    models = model['train'](dictMessages, features, trainIDs, tagList)
+  trainTime = time.time() - trainTime
+  if ('iterations' in models[features[0]]):
+    progress("DONE ({} iterations)\n".format(
+      ", ".join([str(models[f]['iterations']) for f in features])))
+  elif ('network' in models):
+    progress("DONE (centralities {:.3f}s)\n".format(
+      models['network']['centralityTime']))
+  else:
+    progress("DONE\n")
 
-    results['tp'] += tp
-    results['fp'] += fp
-    results['fn'] += fn
-    results['mean-prec'] += precision
-    results['mean-rec']  += recall 
-    if ((precision + recall) > 0):
-      results['mean-f1']   += 2 * (precision * recall) / (precision + recall)
+  if (warmStart):
+    kfoldState['lastModels'] = models
 
-  numTestDocs = len(testDocIDs)
-  results['mean-prec'] /= numTestDocs
-  results['mean-rec']  /= numTestDocs
-  results['mean-f1']   /= numTestDocs
+  # A sweep tests every grid point against the same log odds and
+  # gives one row per point. The test time is that of the whole grid.
+  def testGrid(ids):
+    if (grid is not None):
+      return testSweep(model['sweepBatch'], models, features, dictMessages, 
+                       ids, tagList, grid, testJobs)
+    return {None: test(model['predictBatch'], models, features, dictMessages,
+                       ids, tagList, testJobs)}
 
-  return results
+  if (doTrainTest):
+    progress("  Training Test...........")    
+    resultsTrain = testGrid(trainIDs)
+    progress("DONE\n")
 
+  if (doTest):
+    progress("  Testing.................")    
+    testTime = time.time()
+    resultsTest = testGrid(testIDs)
+    testTime = time.time() - testTime
+    progress("DONE\n")
+
+  outRows = []
+  for p in (grid or [None]):
+    outStr  = "| {} | {} | {} | {} |".format(model['name'], len(docIDs), 
+                                              len(tagList), fold)
+    if (p is not None):
+      outStr += " {} | {} |".format(p[0], p[1])
+    if (doTrainTest):
+      r = resultsTrain[p]
+      outStr += resultString(r['tp'], r['fp'], r['fn'], 
+                             r['mean-prec'], r['mean-rec'], r['mean-f1'])
+    if (doTest):
+      r = resultsTest[p]
+      outStr += resultString(r['tp'], r['fp'], r['fn'], 
+                             r['mean-prec'], r['mean-rec'], r['mean-f1'])
+    outStr += " {:.3f} |".format(trainTime)
+    if (doTest):
+      outStr += " {:.3f} |".format(testTime)
+    outRows.append(outStr)
 
-def resultString(tp, fp, fn, prec, rec, f1):
-  return " {tp} | {fp} | {fn} | {prec:.3f} | {rec:.3f} | {f1:.3f} |".format(
-    tp=tp, fp=fp, fn=fn, prec=prec, rec=rec, f1=f1) 
+  return "\n".join(outRows)
 
 
 def runKfold(model, features, 
              dictMessages, docIDs, tagList, 
              kfolds, kstop, 
-             doTrainTest=True, doTest=True):
+             doTrainTest=True, doTest=True, jobs=1, testJobs=1,
+             warmStart=False, grid=None, initModels=None):
 
   # Randomize the docIDs
   shuffle(docIDs)
@@ -93,9 +159,20 @@ def runKfold(model, features,
 
   sys.stderr.write("DONE\n")
 
-  nTags = len(tagList)
-  nDocs = len(docIDs)
+  # Models with additive training counts are trained by subtracting
+  # each held out fold's counts from those of the whole data set,
+  # instead of counting the training documents again for every fold.
+  fullCounts = None
+  if ((kfolds > 1) and ('count' in model)):
+    sys.stderr.write("Counting data set.........")
+    countTime  = time.time()
+    fullCounts = model['count'](dictMessages, features, docIDs, tagList)
+    countTime  = time.time() - countTime
+    sys.stderr.write("DONE ({:.3f}s)\n".format(countTime))
+
   outStr  = "| MODEL | NDOC | NTAG | FOLD |"
+  if (grid is not None):
+    outStr += " LIMIT | DAMPING |"
   if (doTrainTest):
     outStr += " TrTP |  TrFP | TrFN | TrPREC | TrREC | TrF1 |"
   if (doTest):           
@@ -104,50 +181,39 @@ def runKfold(model, features,
   if (doTest):
     outStr += " TTEST |"
 
+  folds = range(kfolds)
+  if (kstop is not None):
+    folds = folds[0:kstop]
+
+  # Pool workers can't start pools of their own, so testing is
+  # serial within each fold when the folds run in parallel.
+  parallelFolds = (jobs > 1) and (len(folds) > 1)
+  if (parallelFolds):
+    testJobs = 1
+
+  kfoldState.clear()
+  kfoldState.update({'model': model, 'features': features,
+                     'dictMessages': dictMessages, 'docIDs': docIDs,
+                     'tagList': tagList, 'binIDs': binIDs,
+                     'fullCounts': fullCounts, 'doTrainTest': doTrainTest,
+                     'doTest': doTest, 'testJobs': testJobs,
+                     'warmStart': warmStart, 'grid': grid,
+                     'initModels': initModels,
+                     'verbose': not parallelFolds})
+
+  # With -j the folds run in a pool of processes. Each worker times
+  # its own fold and the rows come back in fold order.
   outLog = [outStr]
-  for fold in range(kfolds):
-    if ((kstop is not None) and (fold >= kstop)):
-      break
-
-    sys.stderr.write("-- Fold {}\n".format(fold+1))
-    testIDs  = binIDs[fold]
-    if (kfolds > 1):
-      trainIDs = list((set(docIDs)).difference(testIDs))
-    else:
-      trainIDs = binIDs[fold]
-
-    sys.stderr.write("  Training................")    
-    trainTime = time.time()
-    models  = model['train'](dictMessages, features, trainIDs, tagList)
-    trainTime = time.time() - trainTime
-    sys.stderr.write("DONE\n")
-
-    if (doTrainTest):
-      sys.stderr.write("  Training Test...........")    
-      resultsTrain = test(model['predict'], models, features, dictMessages, trainIDs, tagList)
-      sys.stderr.write("DONE\n")
-
-    if (doTest):
-      sys.stderr.write("  Testing.................")    
-      testTime = time.time()
-      resultsTest = test(model['predict'], models, features, dictMessages, testIDs, tagList)
-      testTime = time.time() - testTime
-      sys.stderr.write("DONE\n")
-
-    outStr  = "| {} | {} | {} | {} |".format(model['name'], nDocs, nTags, fold)
-    if (doTrainTest):
-      outStr += resultString(resultsTrain['tp'], resultsTrain['fp'], resultsTrain['fn'], 
-                             resultsTrain['mean-prec'], resultsTrain['mean-rec'], 
-                             resultsTrain['mean-f1'])
-    if (doTest):
-      outStr += resultString(resultsTest['tp'], resultsTest['fp'], resultsTest['fn'], 
-                             resultsTest['mean-prec'], resultsTest['mean-rec'], 
-                             resultsTest['mean-f1'])
-    outStr += " {:.3f} |".format(trainTime)
-    if (doTest):
-      outStr += " {:.3f} |".format(testTime)
-
-    outLog.append(outStr)
+  if (parallelFolds):
+    pool = multiprocessing.Pool(min(jobs, len(folds)))
+    for fold, outStr in zip(folds, pool.imap(runFold, folds)):
+      sys.stderr.write("-- Fold {} DONE\n".format(fold+1))
+      outLog.append(outStr)
+    pool.close()
+    pool.join()
+  else:
+    for fold in folds:
+      outLog.append(runFold(fold))
 
   for l in  outLog:
     print(l)
@@ -161,13 +227,33 @@ def runKfold(model, features,
 methods = {
   "nbMulti" : {"name": "nbMulti", 
                "train": nbMultiTrain, 
-               "predict": nbMultiPredict},
+               "predict": nbMultiPredict,
+               "predictBatch": nbMultiPredictBatch,
+               "count": nbMultiCount,
+               "subtract": nbMultiSubtract,
+               "trainCounts": nbMultiTrainFromCounts},
   "pmm1"    : {"name": "pmm1",    
                "train": pmm1Train,    
-               "predict": pmm1Predict},
+               "predict": pmm1Predict,
+               "predictBatch": pmm1PredictBatch,
+               "parallelTrain": True,
+               "warmStart": True,
+               "load": pmm1Load},
   "ngnb"    : {"name": "ngnb", 
                "train": ngnbTrain,    
-               "predict": ngnbPredict}
+               "predict": ngnbPredict,
+               "predictBatch": ngnbPredictBatch,
+               "count": ngnbCount,
+               "subtract": ngnbSubtract,
+               "trainCounts": ngnbTrainFromCounts,
+               "sweepBatch": ngnbSweepBatch},
+  "ngnbLazy": {"name": "ngnbLazy", 
+               "train": ngnbTrain,    
+               "predict": ngnbPredictLazy,
+               "predictBatch": ngnbPredictLazyBatch,
+               "count": ngnbCount,
+               "subtract": ngnbSubtract,
+               "trainCounts": ngnbTrainFromCounts}
 }
 
 
@@ -230,9 +316,87 @@ if __name__ == "__main__":
                       dest="doTest",
                       help='Dont do test')
 
+  parser.add_argument('-j',
+                      action="store",
+                      type=int,
+                      dest="jobs",
+                      default=1,
+                      help='Number of folds to run in parallel')
+
+  parser.add_argument('-tj',
+                      action="store",
+                      type=int,
+                      dest="testJobs",
+                      default=1,
+                      help='Number of worker processes for testing each fold')
+
+
+  parser.add_argument('-warm',
+                      action="store_true",
+                      dest="warmStart",
+                      help='Start EM training of each fold from the previous fold')
+
+  parser.add_argument('-init',
+                      action="store",
+                      dest="initDir",
+                      default=None,
+                      help='Start EM training from a model saved by runtest.py -save')
+
+  parser.add_argument('-ej',
+                      action="store",
+                      type=int,
+                      dest="emJobs",
+                      default=1,
+                      help='Number of worker processes for EM training')
+
+  parser.add_argument('-pivots',
+                      action="store",
+                      type=int,
+                      dest="pivots",
+                      default=None,
+                      help='Estimate ngnb centralities from this many pivot tags')
+
+  parser.add_argument('-ccache',
+                      action="store",
+                      dest="centralityCache",
+                      default=None,
+                      help='Directory in which to cache ngnb centralities')
+
+  parser.add_argument('-seed',
+                      action="store",
+                      type=int,
+                      dest="seed",
+                      default=None,
+                      help='Random seed, so repeated runs use the same folds')
+
+  parser.add_argument('-lcache',
+                      action="store",
+                      dest="logOddsCache",
+                      default=None,
+                      help='Directory in which to cache multinomial log odds')
+
+  parser.add_argument('-slimit',
+                      action="store",
+                      type=int,
+                      nargs='+',
+                      dest="searchLimits",
+                      default=None,
+                      help='Sweep the ngnb search limit over these values')
+
+  parser.add_argument('-sdamp',
+                      action="store",
+                      type=float,
+                      nargs='+',
+                      dest="dampingFactors",
+                      default=None,
+                      help='Sweep the ngnb damping factor over these values')
 
   args = parser.parse_args()
 
+  if ((args.pivots is not None) and (args.pivots < 1)):
+    print("Error, -pivots must be at least 1")
+    sys.exit()
+
   if (args.nobody and args.notitle) :
     print("Error, can't omit both body and title")
     sys.exit()
@@ -241,6 +405,39 @@ if __name__ == "__main__":
     print("Error, unknow method")
     sys.exit()
 
+  if ((args.emJobs > 1) and (args.jobs > 1)):
+    print("Error, can't combine -ej with -j")
+    sys.exit()
+
+  if (args.warmStart and (args.jobs > 1)):
+    print("Error, can't combine -warm with -j")
+    sys.exit()
+
+  if ((args.warmStart or (args.initDir is not None)) and 
+      not ('warmStart' in methods[args.method])):
+    print("Error, method does not support warm starts")
+    sys.exit()
+
+  if (args.emJobs > 1):
+    if (not ('parallelTrain' in methods[args.method])):
+      print("Error, method does not support parallel training")
+      sys.exit()
+    methods[args.method]['train'] = functools.partial(
+      methods[args.method]['train'], jobs=args.emJobs)
+
+  # A sweep over either parameter keeps the other at its default
+  grid = None
+  if ((args.searchLimits is not None) or (args.dampingFactors is not None)):
+    if (not ('sweepBatch' in methods[args.method])):
+      print("Error, method does not support parameter sweeps")
+      sys.exit()
+    grid = [(l, d) for l in (args.searchLimits or [ngnb.SEARCH_LIMIT])
+                   for d in (args.dampingFactors or [ngnb.DAMPING_FACTOR])]
+
+  ngnb.CENTRALITY_PIVOTS = args.pivots
+  ngnb.CENTRALITY_CACHE  = args.centralityCache
+  nbMultinomial.LOGODDS_CACHE = args.logOddsCache
+
   features = []
   if (not args.notitle):
     features.append('title')
@@ -248,18 +445,30 @@ if __name__ == "__main__":
   if (not args.nobody):
     features.append('body')
 
+  # A saved model, e.g. trained on the whole data set, to start from
+  initModels = None
+  if (args.initDir is not None):
+    kind, initFeatures, initTags = modelDirLoad(args.initDir)
+    if ((kind != args.method) or (not set(features) <= set(initFeatures))):
+      print("Error, {} is not a {} model of the same features".format(
+        args.initDir, args.method))
+      sys.exit()
+    initModels = methods[args.method]['load'](args.initDir, features)
+
   sys.stderr.write("Loading dictionaries......")
-  fdDicts = open(args.trainFile, 'rb')
-  reader = Unpickler(fdDicts)
-  dictMessages  = reader.load()
-  dictTagCounts = reader.load()
-  dictTagIndex  = reader.load()
-  fdDicts.close()
+  dictMessages, dictTagCounts, dictTagIndex = loadDictionaries(args.trainFile)
   sys.stderr.write("DONE\n")
 
   docIDs   = dictMessages.keys()
   tagList  = dictTagCounts.keys()
 
+  # With a seed the shuffles below and the fold assignment repeat
+  # from run to run, so -lcache and -ccache files are reused
+  if (args.seed is not None):
+    random.seed(args.seed)
+    docIDs  = sorted(docIDs)
+    tagList = sorted(tagList)
+
   if (args.ntag is not None):
     shuffle(tagList)
     tagList = tagList[0:args.ntag]
@@ -278,4 +487,5 @@ if __name__ == "__main__":
   runKfold(methods[args.method], features, 
            dictMessages, docIDs, tagList, 
            args.k, args.kstop, 
-           args.doTrainTest, args.doTest)
+           args.doTrainTest, args.doTest, args.jobs, args.testJobs,
+           args.warmStart, grid, initModels)
@@ -10,65 +10,20 @@
 import os, os.path
 import sys
 import argparse
+import itertools
 import time
+import functools
 
-from cPickle       import Unpickler
 from random        import shuffle
+from messageStore  import loadDictionaries
+from evaluate      import test, resultString
+from modelStore    import modelDirLoad
 from nbMultinomial import *
 from pmm1          import *
 from ngnb          import *
 
-
-# ------------------------------------------------------------
-# TEST
-
-
-def test(fnPredict, models, features, dictMessages, testDocIDs, tagList):
-  results = {'tp': 0, 'fp': 0, 'fn': 0, 
-             'mean-prec': 0, 'mean-rec': 0, 
-             'mean-f1':0}
-  for sid in testDocIDs:
-    tagsActual  = set([t for t in dictMessages[sid]['tags'] if t in tagList])
-
-    predictions = set()
-    for f in features:
-      text = dictMessages[sid][f]
-      predictions |= set(fnPredict(models, f, text, tagList))
-
-    #print(",".join(tagsActual) + " : " + ",".join(predictions))
-    tp = len(tagsActual & predictions)
-    fp = len(predictions - tagsActual)
-    fn = len(tagsActual - predictions) 
-
-    if ((tp + fp) > 0):
-      precision = float(tp) / (tp + fp)
-    else: 
-      precision = 0
-
-    if ((tp+fn) > 0):
-      recall = float(tp) / (tp + fn)   
-    else:
-      recall = 0
-
-    results['tp'] += tp
-    results['fp'] += fp
-    results['fn'] += fn
-    results['mean-prec'] += precision
-    results['mean-rec']  += recall 
-    if ((precision + recall) > 0):
-      results['mean-f1']   += 2 * (precision * recall) / (precision + recall)
-
-  numTestDocs = len(testDocIDs)
-  results['mean-prec'] /= numTestDocs
-  results['mean-rec']  /= numTestDocs
-  results['mean-f1']   /= numTestDocs
-
-  return results
-
-
-def resultString(tp, fp, fn, prec, rec, f1):
-  return " {tp} | {fp} | {fn} | {prec:.3f} | {rec:.3f} | {f1:.3f} |".format(
-    tp=tp, fp=fp, fn=fn, prec=prec, rec=rec, f1=f1) 
+import nbMultinomial
+import ngnb
 
 
 # ------------------------------------------------------------
@@ -78,13 +33,31 @@ def resultString(tp, fp, fn, prec, rec, f1):
 methods = {
   "nbMulti" : {"name": "nbMulti", 
                "train": nbMultiTrain, 
-               "predict": nbMultiPredict},
+               "trainStream": nbMultiTrainStream,
+               "predict": nbMultiPredict,
+               "predictBatch": nbMultiPredictBatch,
+               "save": nbMultiSave,
+               "load": nbMultiLoad},
   "pmm1"    : {"name": "pmm1",    
                "train": pmm1Train,    
-               "predict": pmm1Predict},
+               "predict": pmm1Predict,
+               "predictBatch": pmm1PredictBatch,
+               "parallelTrain": True,
+               "warmStart": True,
+               "save": pmm1Save,
+               "load": pmm1Load},
   "ngnb"    : {"name": "ngnb", 
                "train": ngnbTrain,    
-               "predict": ngnbPredict}
+               "predict": ngnbPredict,
+               "predictBatch": ngnbPredictBatch,
+               "save": ngnbSave,
+               "load": ngnbLoad},
+  "ngnbLazy": {"name": "ngnbLazy", 
+               "train": ngnbTrain,    
+               "predict": ngnbPredictLazy,
+               "predictBatch": ngnbPredictLazyBatch,
+               "save": ngnbSave,
+               "load": ngnbLoad}
 }
 
 
@@ -97,7 +70,7 @@ if __name__ == "__main__":
                       help='Method to use')
 
   parser.add_argument('trainFile',
-                      help='Training file.')
+                      help='Training file. With -stream, a comma separated list of CSV files.')
 
   parser.add_argument('testFile',
                       help='Testing file.')
@@ -112,9 +85,73 @@ if __name__ == "__main__":
                       dest="notitle",
                       help='Dont include the title')
 
+  parser.add_argument('-stream',
+                      action="store_true",
+                      dest="stream",
+                      help='Train by streaming messages from CSV files made by createFilteredDataset')
+
+  parser.add_argument('-clean',
+                      action="store_true",
+                      dest="clean",
+                      help='With -stream, clean raw training CSV files while reading them')
+
+  parser.add_argument('-tj',
+                      action="store",
+                      type=int,
+                      dest="testJobs",
+                      default=1,
+                      help='Number of worker processes for testing')
+
+
+  parser.add_argument('-ej',
+                      action="store",
+                      type=int,
+                      dest="emJobs",
+                      default=1,
+                      help='Number of worker processes for EM training')
+
+  parser.add_argument('-pivots',
+                      action="store",
+                      type=int,
+                      dest="pivots",
+                      default=None,
+                      help='Estimate ngnb centralities from this many pivot tags')
+
+  parser.add_argument('-ccache',
+                      action="store",
+                      dest="centralityCache",
+                      default=None,
+                      help='Directory in which to cache ngnb centralities')
+
+  parser.add_argument('-lcache',
+                      action="store",
+                      dest="logOddsCache",
+                      default=None,
+                      help='Directory in which to cache multinomial log odds')
+
+  parser.add_argument('-save',
+                      action="store",
+                      dest="saveDir",
+                      default=None,
+                      help='Directory in which to save the trained model')
+
+  parser.add_argument('-load',
+                      action="store_true",
+                      dest="load",
+                      help='Load a model saved with -save from trainFile instead of training')
+
+  parser.add_argument('-init',
+                      action="store",
+                      dest="initDir",
+                      default=None,
+                      help='Start EM training from a model saved with -save')
 
   args = parser.parse_args()
 
+  if ((args.pivots is not None) and (args.pivots < 1)):
+    print("Error, -pivots must be at least 1")
+    sys.exit()
+
   if (args.nobody and args.notitle) :
     print("Error, can't omit both body and title")
     sys.exit()
@@ -123,6 +160,33 @@ if __name__ == "__main__":
     print("Error, unknow method")
     sys.exit()
 
+  if (args.load and (args.stream or (args.saveDir is not None))):
+    print("Error, can't combine -load with -stream or -save")
+    sys.exit()
+
+  if ((args.initDir is not None) and (args.load or args.stream)):
+    print("Error, can't combine -init with -load or -stream")
+    sys.exit()
+
+  if ((args.initDir is not None) and not ('warmStart' in methods[args.method])):
+    print("Error, method does not support warm starts")
+    sys.exit()
+
+  if (args.stream and not ('trainStream' in methods[args.method])):
+    print("Error, method does not support streaming")
+    sys.exit()
+
+  if (args.emJobs > 1):
+    if (not ('parallelTrain' in methods[args.method])):
+      print("Error, method does not support parallel training")
+      sys.exit()
+    methods[args.method]['train'] = functools.partial(
+      methods[args.method]['train'], jobs=args.emJobs)
+
+  ngnb.CENTRALITY_PIVOTS = args.pivots
+  ngnb.CENTRALITY_CACHE  = args.centralityCache
+  nbMultinomial.LOGODDS_CACHE = args.logOddsCache
+
   features = []
   if (not args.notitle):
     features.append('title')
@@ -131,33 +195,57 @@ if __name__ == "__main__":
     features.append('body')
 
   sys.stderr.write("Loading dictionaries......")
-  fdDicts = open(args.trainFile, 'rb')
-  trainReader = Unpickler(fdDicts)
-  trainMessages  = trainReader.load()
-  trainTagCounts = trainReader.load()
-  trainTagIndex  = trainReader.load()
-  fdDicts.close()
-
-  fdDicts = open(args.testFile, 'rb')
-  testReader = Unpickler(fdDicts)
-  testMessages  = testReader.load()
-  testTagCounts = testReader.load()
-  testTagIndex  = testReader.load()
-  fdDicts.close()
+  if (not (args.stream or args.load)):
+    trainMessages, trainTagCounts, trainTagIndex = loadDictionaries(args.trainFile)
+  testMessages,  testTagCounts,  testTagIndex  = loadDictionaries(args.testFile)
 
   sys.stderr.write("DONE\n")
 
-  trainIDs = trainMessages.keys()
   testIDs  = testMessages.keys()
-  tagList  = trainTagCounts.keys()
 
   sys.stderr.write("  Training................")    
-  models      = methods[args.method]['train'](trainMessages, features, trainIDs, tagList)
+  if (args.load):
+    # The saved model's features and tags replace the options
+    kind, features, tagList = modelDirLoad(args.trainFile)
+    if (methods[kind]['load'] is not methods[args.method]['load']):
+      print("Error, {} is a saved {} model".format(args.trainFile, kind))
+      sys.exit()
+    models = methods[args.method]['load'](args.trainFile, features)
+  elif (args.stream):
+    # The training messages are never held in memory, so take the
+    # tag list from the test set, which was built with the same tags.
+    tagList = testTagIndex.keys()
+    if (args.clean):
+      from createFilteredDataset import iterCleanMessages as iterMessages
+    else:
+      from createDictionaries import iterMessages
+
+    messages = itertools.chain.from_iterable(
+      [iterMessages(fileName, tagList) for fileName in args.trainFile.split(',')])
+    models = methods[args.method]['trainStream']((m for sid,m in messages), 
+                                                 features, tagList)
+  else:
+    trainIDs = trainMessages.keys()
+    tagList  = trainTagCounts.keys()
+    if (args.initDir is not None):
+      kind, initFeatures, initTags = modelDirLoad(args.initDir)
+      if ((kind != args.method) or (not set(features) <= set(initFeatures))):
+        print("Error, {} is not a {} model of the same features".format(
+          args.initDir, args.method))
+        sys.exit()
+      models = methods[args.method]['train'](
+        trainMessages, features, trainIDs, tagList,
+        init=methods[args.method]['load'](args.initDir, features))
+    else:
+      models = methods[args.method]['train'](trainMessages, features, trainIDs, tagList)
   sys.stderr.write("DONE\n")
 
+  if (args.saveDir is not None):
+    methods[args.method]['save'](models, features, tagList, args.saveDir)
+
   sys.stderr.write("  Testing.................")    
-  resultsTest = test(methods[args.method]['predict'], models, features, testMessages, 
-                     testIDs, tagList)
+  resultsTest = test(methods[args.method]['predictBatch'], models, features, testMessages, 
+                     testIDs, tagList, args.testJobs)
   sys.stderr.write("DONE\n\n")
 
   nTags = len(tagList)
@@ -12,8 +12,8 @@ import sys
 import argparse
 import time
 
-from collections import Counter
-from cPickle     import Unpickler
+from collections  import Counter
+from messageStore import loadDictionaries
 
 
 
@@ -36,12 +36,7 @@ if __name__ == "__main__":
 
 
   sys.stderr.write("Loading dictionaries......")
-  fdDicts = open(args.trainFile, 'rb')
-  dictReader = Unpickler(fdDicts)
-  dictMessages  = dictReader.load()
-  dictTagCounts = dictReader.load()
-  dictTagIndex  = dictReader.load()
-  fdDicts.close()
+  dictMessages, dictTagCounts, dictTagIndex = loadDictionaries(args.trainFile)
   sys.stderr.write("DONE\n")
 
   docIDs  = dictMessages.keys()